@@ -0,0 +1,235 @@
+# TechKnAcq: Synthetic Benchmark Data
+# Jonathan Gordon
+
+import os
+import io
+import json
+import numpy as np
+
+
+# Parameters
+
+# The queries used for reading lists in test/gen-lists.sh.
+STANDARD_QUERIES = [
+    'machine translation', 'dependency parsing', 'sentiment analysis',
+    'speech recognition', 'document summarization', 'machine learning',
+    'concept-to-text generation', 'distributional semantics',
+    'domain adaptation', 'information extraction', 'lexical semantics',
+    'parser evaluation', 'statistical machine translation models',
+    'statistical parsing', 'question answering', 'parsing',
+    'coreference resolution', 'word sense disambiguation',
+    'morphological segmentation'
+]
+
+SOURCES = ['acl', 'sd', 'wiki', 'web']
+
+# The topic model is trained on bigrams, as by concept-graph, so the
+# vocabulary is of two-word phrases, each written as two words in documents.
+VOCAB_SIZE = 20000
+KEY_WORDS = 40
+TOPICS_PER_DOC = 3
+DEPS_PER_TOPIC = 5
+CITATIONS_PER_DOC = 8
+SENTENCE_WORDS = 20
+
+# Share of each document's words drawn from its topics' key words, rather
+# than from the Zipfian background distribution.
+TOPIC_WORD_SHARE = 0.6
+
+# Share of documents with pedagogical role annotations.
+ROLE_SHARE = 0.2
+
+SYLLABLES = ['ba', 'ko', 'ri', 'te', 'mu', 'sa', 'ne', 'lo', 'pi', 'da',
+             'fe', 'gu', 'hi', 'jo', 'ka', 'ze', 'vo', 'wu', 'xi', 'yo']
+
+
+def pseudo_word(i):
+    """Return a distinct pronounceable nonsense word for each number."""
+    syllables = []
+    while True:
+        i, r = divmod(i, len(SYLLABLES))
+        syllables.append(SYLLABLES[r])
+        if i == 0:
+            break
+        i -= 1
+    return 'q' + ''.join(syllables)
+
+
+def query_phrases(q):
+    """Return the bigrams of a query, joined by underscores."""
+    tokens = q.replace('-', ' ').split()
+    if len(tokens) == 1:
+        tokens.append('methods')
+    return [a + '_' + b for a, b in zip(tokens, tokens[1:])]
+
+
+class SyntheticData:
+    """A synthetic corpus of `docs` documents of about `words` words each,
+    with a matching Mallet topic model of `topics` topics, role
+    annotations, and topic dependencies, written to a work directory. The
+    standard queries' bigrams are key phrases of the first topics, so reading
+    lists for them have concepts to match. The same seed always produces
+    the same data."""
+
+    def __init__(self, workdir, docs, topics=200, words=350, seed=0):
+        self.workdir = workdir
+        self.num_docs = docs
+        self.num_topics = max(topics, len(STANDARD_QUERIES))
+        self.words = words
+        self.seed = seed
+
+        self.corpus_dir = os.path.join(workdir, 'corpus')
+        self.model_prefix = os.path.join(workdir, 'model', '')
+        self.roles_file = os.path.join(workdir, 'pedagogical-roles.txt')
+        self.manifest = os.path.join(workdir, 'manifest.json')
+
+        rng = np.random.default_rng(seed)
+
+        # Vocabulary: query bigrams, then pairs of nonsense words.
+        vocab = list(dict.fromkeys(p for q in STANDARD_QUERIES
+                                   for p in query_phrases(q)))
+        vocab += [pseudo_word(2*i) + '_' + pseudo_word(2*i + 1)
+                  for i in range(VOCAB_SIZE - len(vocab))]
+        self.vocab = np.array(vocab, dtype=object)
+
+        # Zipfian background distribution, as a CDF for sampling.
+        p = 1.0 / np.arange(1, len(vocab) + 1)
+        self.cdf = np.cumsum(p / p.sum())
+
+        # Key phrases of each topic, starting with a query's bigrams for the
+        # first topics.
+        index = {w: i for i, w in enumerate(vocab)}
+        self.topic_words = rng.integers(len(vocab), size=(self.num_topics,
+                                                          KEY_WORDS))
+        for t, q in enumerate(STANDARD_QUERIES):
+            keys = query_phrases(q)
+            self.topic_words[t, :len(keys)] = [index[w] for w in keys]
+
+        self.doc_ids = ['%s-%07d' % (SOURCES[i % len(SOURCES)], i)
+                        for i in range(docs)]
+
+    def exists(self):
+        """Check if the data was already generated with these settings."""
+        if not os.path.exists(self.manifest):
+            return False
+        with open(self.manifest) as f:
+            return json.load(f) == self.settings()
+
+    def settings(self):
+        return {'docs': self.num_docs, 'topics': self.num_topics,
+                'words': self.words, 'seed': self.seed}
+
+    def generate(self):
+        os.makedirs(self.corpus_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(self.model_prefix), exist_ok=True)
+
+        rng = np.random.default_rng(self.seed + 1)
+        word_topic = {}
+
+        with io.open(self.model_prefix + 'composition.txt', 'w',
+                     encoding='utf-8') as dt, \
+             io.open(self.roles_file, 'w', encoding='utf-8') as roles:
+            dt.write('#doc name topic proportion ...\n')
+            roles.write('doc_id\tsurvey\ttutorial\tresource\treference\t'
+                        'empirical\tmanual\tother\n')
+            for i, doc_id in enumerate(self.doc_ids):
+                topics = rng.choice(self.num_topics, size=TOPICS_PER_DOC,
+                                    replace=False)
+                doc = self.document(i, doc_id, topics, rng, word_topic)
+                with io.open(os.path.join(self.corpus_dir, doc_id + '.json'),
+                             'w', encoding='utf-8') as out:
+                    json.dump(doc, out, ensure_ascii=False)
+
+                weights = rng.random(self.num_topics) * 0.001
+                weights[topics] += rng.dirichlet(np.ones(len(topics)))
+                weights /= weights.sum()
+                dt.write('%d\t%s\t%s\n' %
+                         (i, os.path.join(self.corpus_dir, doc_id + '.txt'),
+                          '\t'.join(['%.6f' % x for x in weights])))
+
+                if rng.random() < ROLE_SHARE:
+                    r = rng.dirichlet(np.ones(7))
+                    roles.write(doc_id.split('-', 1)[1] + '\t' +
+                                '\t'.join(['%.4f' % x for x in r]) + '\n')
+
+        with io.open(self.model_prefix + 'word-topic-counts.txt', 'w',
+                     encoding='utf-8') as wt:
+            for i, w in enumerate(sorted(word_topic)):
+                wt.write('%d %s %s\n' %
+                         (i, self.vocab[w],
+                          ' '.join('%d:%d' % x for x in
+                                   sorted(word_topic[w].items(),
+                                          key=lambda x: -x[1]))))
+
+        with io.open(self.model_prefix + 'keys.txt', 'w',
+                     encoding='utf-8') as keys:
+            for t in range(self.num_topics):
+                keys.write('%d\t0.05\t%s\n' %
+                           (t, ' '.join(self.vocab[self.topic_words[t,
+                                                                    :20]])))
+
+        with open(self.manifest, 'w') as out:
+            json.dump(self.settings(), out)
+
+    def document(self, i, doc_id, topics, rng, word_topic):
+        """Return the JSON for a synthetic document about the topics,
+        counting its words for the word-topic file."""
+
+        n = self.words // 2
+        from_topic = rng.random(n) < TOPIC_WORD_SHARE
+        which = rng.integers(len(topics), size=n)
+        keys = self.topic_words[topics[which], rng.integers(KEY_WORDS,
+                                                            size=n)]
+        background = np.minimum(np.searchsorted(self.cdf, rng.random(n)),
+                                len(self.vocab) - 1)
+        words = np.where(from_topic, keys, background)
+
+        # Attribute each phrase to a topic as Mallet would.
+        for w, t in zip(words, topics[which]):
+            counts = word_topic.setdefault(w, {})
+            counts[t] = counts.get(t, 0) + 1
+
+        tokens = ' '.join(self.vocab[words]).replace('_', ' ').split()
+        sents = [' '.join(tokens[j:j+SENTENCE_WORDS]).capitalize() + '.'
+                 for j in range(0, len(tokens), SENTENCE_WORDS)]
+        title_words = self.vocab[self.topic_words[topics[0],
+                                                  rng.integers(KEY_WORDS,
+                                                               size=2)]]
+        title = ' '.join(x.replace('_', ' ') for x in title_words).title()
+
+        cites = []
+        if i > 0:
+            cites = sorted(set(self.doc_ids[j] for j in
+                               rng.integers(i, size=min(i,
+                                                        CITATIONS_PER_DOC))))
+        book = 'Tutorials in ' + title if doc_id.startswith('web') else \
+               'Proceedings of the Synthetic Workshop'
+
+        return {'info': {'id': doc_id,
+                         'authors': ['Author %d' % (rng.integers(5000)),
+                                     'Author %d' % (rng.integers(5000))],
+                         'title': title,
+                         'book': book,
+                         'year': int(1990 + i % 30),
+                         'url': 'http://example.org/' + doc_id},
+                'references': cites,
+                'sections': [{'heading': 'Abstract', 'text': sents[:3]},
+                             {'heading': 'Introduction',
+                              'text': sents[3:len(sents)//2]},
+                             {'heading': 'Results',
+                              'text': sents[len(sents)//2:]}]}
+
+    def dependencies(self):
+        """Return dependency edges between topics, as from
+        TopicDependency: a dict of dicts of weights keyed by topic number
+        strings."""
+        rng = np.random.default_rng(self.seed + 2)
+        edges = {}
+        for t in range(self.num_topics):
+            deps = rng.choice(self.num_topics, size=DEPS_PER_TOPIC,
+                              replace=False)
+            edges[str(t)] = {str(d): float(w) for d, w in
+                             zip(deps, rng.uniform(0.05, 1.0,
+                                                   size=DEPS_PER_TOPIC))
+                             if d != t}
+        return edges
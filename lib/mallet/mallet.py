@@ -9,10 +9,12 @@ import re
 import subprocess
 import multiprocessing as mp
 
-from numpy import zeros
-from itertools import combinations
+import scipy.sparse as sp
+
+from numpy import zeros, array, fill_diagonal, float64
 
 from techknacq.lx import StopLexicon
+from techknacq.instrument import traced
 
 
 # Parameters
@@ -88,6 +90,7 @@ class Mallet:
             sys.exit(1)
 
 
+    @traced('mallet.train')
     def train(self, num_topics, iters):
         cmd = [self.path, 'train-topics',
                '--input', self.prefix + 'corpus.mallet',
@@ -108,6 +111,7 @@ class Mallet:
             sys.exit(1)
 
 
+    @traced('mallet.infer_topics')
     def infer_topics(self, corpus, iters=1000):
         # Read corpus using the original corpus file as a pipe to ensure
         # compatability.
@@ -134,6 +138,7 @@ class Mallet:
         self.load_dt()
 
 
+    @traced('mallet.load_keys')
     def load_keys(self):
         """Read the Dirichlet parameters from the topic key file."""
         print('Loading key file.')
@@ -144,6 +149,7 @@ class Mallet:
             self.params[topic_num] = parameter
 
 
+    @traced('mallet.load_wt')
     def load_wt(self):
         print('Loading word-topic file.')
         for line in open(self.wtfile):
@@ -160,14 +166,13 @@ class Mallet:
                                      self.topic_pairs(topic)[:20]]) + '\n')
 
 
+    @traced('mallet.load_dt')
     def load_dt(self):
         print('Loading document-topic composition file.')
 
         file_format = None
 
         num_topics = len(self.topics)
-        self.topic_doc = [[] for i in range(num_topics)]
-        self.co_occur = zeros((num_topics, num_topics), int)
 
         # We need a cut-off for a topic to count as non-trivially occurring
         # in a document, and this needs to vary depending on the number of
@@ -178,6 +183,11 @@ class Mallet:
         # adjusted for other corpora.
         thresh = max((290.0 - num_topics)/900.0, 0.01)
 
+        # Document IDs, in file order, and the corresponding rows of the
+        # (documents x topics) composition matrix.
+        self.doc_ids = []
+        rows = []
+
         for line in open(self.dtfile):
             row = line.strip().split()
             if row[0][0] == '#':
@@ -190,30 +200,33 @@ class Mallet:
             except:
                 continue
 
+            weights = zeros(num_topics)
             try:
                 # Mallet's old format: Topic ID, weight pairs sorted
                 # by weight.
-                topics = [(int(a), float(b)) for (a, b) in
-                          zip(row[2::2], row[3::2])]
+                for (a, b) in zip(row[2::2], row[3::2]):
+                    weights[int(a)] = float(b)
             except:
                 # Mallet's new format: The weight for each topic,
                 # ordered by topic ID.
-                topics = [(a, float(b)) for (a, b) in
-                          enumerate(row[2:])]
+                weights = array(row[2:], dtype=float)
                 file_format = 'new'
 
-            # Read into document topic breakdown information.
-            for topic_id, percent in topics:
-                self.topic_doc[topic_id].append((base, percent))
+            self.doc_ids.append(base)
+            rows.append(weights)
+
+        self.doc_topic = array(rows).reshape(len(rows), num_topics)
 
-            # Read into co-occurrence matrix.
-            filt_topics = [(a, b) for (a, b) in topics if b > thresh]
-            for topic_pair in combinations(filt_topics, 2):
-                i1 = topic_pair[0][0]
-                i2 = topic_pair[1][0]
-                # Symmetric matrix.
-                self.co_occur[i1][i2] += 1
-                self.co_occur[i2][i1] += 1
+        # Read into document topic breakdown information.
+        self.topic_doc = [list(zip(self.doc_ids,
+                                   self.doc_topic[:, topic_id].tolist()))
+                          for topic_id in range(num_topics)]
+
+        # Read into co-occurrence matrix: the number of documents in which
+        # each pair of distinct topics both occur. Symmetric matrix.
+        occurs = (self.doc_topic > thresh).astype(int)
+        self.co_occur = occurs.T.dot(occurs)
+        fill_diagonal(self.co_occur, 0)
 
         with open(self.cofile, 'w') as out:
             for row in self.co_occur:
@@ -237,6 +250,7 @@ class Mallet:
             self.dtfile += '-old-format'
 
 
+    @traced('mallet.load_names')
     def load_names(self):
         """Load topic names from disk, if they exist. Otherwise, set
         every topic's name to its first three elements."""
@@ -260,6 +274,7 @@ class Mallet:
             self.names[int(topic)] = name
 
 
+    @traced('mallet.load_scores')
     def load_scores(self):
         """Load the topic scores from disk, if they exist. Otherwise,
         set every topic score to 1.0."""
@@ -277,6 +292,26 @@ class Mallet:
             self.scores.append(float(line))
 
 
+    def word_topic_matrix(self):
+        """Return the vocabulary of the topic model as a dict from word to
+        row index and a sparse (words x topics) matrix of word-topic
+        counts."""
+
+        vocab = {}
+        rows = []
+        cols = []
+        vals = []
+        for topic in range(len(self.topics)):
+            for word, count in self.topics[topic].items():
+                rows.append(vocab.setdefault(word, len(vocab)))
+                cols.append(topic)
+                vals.append(count)
+        wt = sp.csr_matrix((vals, (rows, cols)),
+                           shape=(len(vocab), len(self.topics)),
+                           dtype=float64)
+        return vocab, wt
+
+
     def topic_pairs(self, topic):
         return sorted(self.topics[topic].items(),
                       key=lambda x: (-1.0 * x[1], x[0]))
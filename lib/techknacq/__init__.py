@@ -1,4 +1,6 @@
-__all__ = ['conceptgraph', 'corpus', 'lx', 'readinglist']
+__all__ = ['cache', 'conceptgraph', 'corpus', 'fetch', 'instrument',
+           'liststore', 'lx', 'pdf', 'readinglist', 'stages', 'terms',
+           'wikidump']
 
 __version__ = '0.0'
 __author__ = 'Jonathan Gordon <jgordon@isi.edu>'
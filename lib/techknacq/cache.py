@@ -0,0 +1,148 @@
+# TechKnAcq: Cache
+# Jonathan Gordon
+
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# Parameters
+
+CACHE_PATH = 'data/http-cache.sqlite'
+CACHE_TTL = 30 * 24 * 60 * 60
+CACHE_SIZE = 1 << 30
+
+# Number of puts between counting the total size of the entries, which
+# other processes may also add to. In between, it's estimated.
+RECOUNT_INTERVAL = 1000
+
+# Query parameters that don't affect the response, e.g., API keys, and so
+# are left out of cache keys.
+IGNORED_PARAMS = {'apikey', 'key'}
+
+
+class ResponseCache:
+    """Persistent cache of HTTP responses (or other lookups), stored in
+    SQLite and keyed on the normalized URL and query parameters. Entries
+    expire after `ttl` seconds, and the least recently used entries are
+    evicted once the bodies exceed `max_bytes`. In offline mode, callers
+    should only serve responses from the cache.
+
+    Each process and thread opens its own connection, so a cache can be
+    shared with multiprocessing workers and threads."""
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_bytes=CACHE_SIZE,
+                 offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.conns = {}
+        self.total = None
+        self.puts = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conns'] = {}
+        state['total'] = None
+        state['puts'] = 0
+        return state
+
+    def db(self):
+        owner = (os.getpid(), threading.get_ident())
+        conn = self.conns.get(owner)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS responses
+                                 (key TEXT PRIMARY KEY, url TEXT,
+                                  status INTEGER, body BLOB,
+                                  created REAL, accessed REAL,
+                                  size INTEGER)''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS accessed
+                            ON responses (accessed)''')
+            self.conns[owner] = conn
+        return conn
+
+    @staticmethod
+    def key(url, params=None):
+        """Return the cache key for a URL and dict of query parameters."""
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query) + \
+                [(k, str(v)) for k, v in (params or {}).items()]
+        query = sorted((k, v) for k, v in query if k not in IGNORED_PARAMS)
+        norm = urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                           parts.path, urlencode(query), ''))
+        return hashlib.sha256(norm.encode('utf8')).hexdigest()
+
+    def get(self, url, params=None):
+        """Return the cached (status, body) pair for the request, or None
+        if it isn't cached or has expired."""
+        key = self.key(url, params)
+        now = time.time()
+        with self.db() as conn:
+            row = conn.execute('SELECT status, body, created FROM responses '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            status, body, created = row
+            if self.ttl is not None and now - created > self.ttl and \
+               not self.offline:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                         (now, key))
+        return status, body
+
+    def put(self, url, params, status, body):
+        """Cache the response body (bytes) for the request."""
+        now = time.time()
+        with self.db() as conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?)',
+                         (self.key(url, params), url, status, body, now, now,
+                          len(body)))
+        self.evict(len(body))
+
+    def get_json(self, url, params=None):
+        """Return the cached JSON value for the lookup, or None."""
+        cached = self.get(url, params)
+        if cached is None:
+            return None
+        return json.loads(cached[1].decode('utf8'))
+
+    def put_json(self, url, params, value):
+        """Cache a JSON-serializable value for the lookup."""
+        self.put(url, params, 200, json.dumps(value).encode('utf8'))
+
+    def evict(self, added=0):
+        """Remove the least recently used entries until the cache is
+        within its size bound, after a put of `added` bytes. The total size
+        is only counted every RECOUNT_INTERVAL puts, or when the estimate
+        exceeds the bound."""
+        if self.max_bytes is None:
+            return
+        self.puts += 1
+        if self.total is not None and self.puts % RECOUNT_INTERVAL:
+            self.total += added
+            if self.total <= self.max_bytes:
+                return
+        with self.db() as conn:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM responses').fetchone()[0]
+            self.total = total
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            for key, size in conn.execute('SELECT key, size FROM responses '
+                                          'ORDER BY accessed').fetchall():
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total -= size
+                excess -= size
+                if excess <= 0:
+                    break
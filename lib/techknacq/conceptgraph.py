@@ -2,14 +2,44 @@
 # Jonathan Gordon
 
 import sys
+import os
+import time
 import networkx as nx
 import json
 import uuid
+import heapq
+import types
+import re
+
+from collections import defaultdict
+
+from techknacq.instrument import traced
 
 # Parameters
 
 WORDS_PER_CONCEPT = 100
 
+# The most documents topic_docs will return for a concept.
+MAX_TOPIC_DOCS = 200
+
+# Retention policy for concept-document edges: Each concept keeps edges to
+# its TOPIC_DOC_EDGES highest-weighted documents, and each document keeps
+# edges to its DOC_TOPIC_EDGES highest-weighted concepts of at least
+# MIN_DOC_TOPIC_WEIGHT. All other edges are dropped.
+TOPIC_DOC_EDGES = MAX_TOPIC_DOCS
+DOC_TOPIC_EDGES = 10
+MIN_DOC_TOPIC_WEIGHT = 0.01
+
+# Arrays of records in a concept graph file, by their path of keys.
+RECORD_ARRAYS = {('nodes',), ('edges',), ('corpus', 'docs')}
+
+# Characters of a concept graph file read at a time.
+CHUNK_SIZE = 1 << 24
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+ITEM_END_RE = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+NUMBER_RE = re.compile(r'[-+0-9.eE]*')
+
 
 class ConceptGraph:
     def __init__(self, fname=None):
@@ -19,19 +49,26 @@ class ConceptGraph:
         # We export lists of (concept) nodes and edges, but we internally
         # store everything as a NetworkX graph.
         self.g = nx.DiGraph()
+        # Values derived from the graph, e.g., sorted dependencies and
+        # ranked documents, shared by every reading list made from it.
+        # They are cleared when the graph is changed by any method below.
+        self.cache = {}
 
         if fname:
             self.load(fname)
 
 
+    @traced('conceptgraph.add_docs')
     def add_docs(self, corpus):
         """Add each document from the corpus as a node in the ConceptGraph
         and add edges for any citation information."""
 
+        self.cache.clear()
+
         print('Adding documents to concept graph.')
 
         for doc in corpus:
-            doc_length = len(doc.text().split())
+            doc_length = doc.word_count()
             if doc_length < 300:
                 continue
             self.g.add_node(doc.id, type='document', authors=doc.authors,
@@ -42,11 +79,18 @@ class ConceptGraph:
                 self.g.add_edge(doc.id, ref, type='cite')
 
 
-    def add_concepts(self, model):
+    @traced('conceptgraph.add_concepts')
+    def add_concepts(self, model, topic_doc_edges=TOPIC_DOC_EDGES,
+                     doc_topic_edges=DOC_TOPIC_EDGES,
+                     min_doc_topic_weight=MIN_DOC_TOPIC_WEIGHT):
         """Add each topic from the topic model as a node in the
-        ConceptGraph."""
+        ConceptGraph, linked to its `topic_doc_edges` most relevant
+        documents. Each document is also linked to its `doc_topic_edges`
+        most relevant topics with weight of at least
+        `min_doc_topic_weight`. A limit of None keeps every edge."""
 
         print('Adding concepts to concept graph.')
+        self.cache.clear()
 
         # Add a concept node for each topic in the model.
         for topic in range(len(model.topics)):
@@ -57,19 +101,49 @@ class ConceptGraph:
                 self.g.node[concept_id]['words'].append((word, weight))
                 self.g.node[concept_id]['mentions'] += weight
 
-        # Link the concept nodes to documents.
+        def push(heap, item, limit):
+            """Add the item to a min-heap holding at most `limit` items."""
+            if limit is None or len(heap) < limit:
+                heapq.heappush(heap, item)
+            elif limit > 0 and item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        # Find the edges to keep, holding only the strongest candidates for
+        # each topic and each document at any time.
+        candidates = 0
+        doc_heaps = defaultdict(list)
+        edges = {}
         for topic in range(len(model.topic_doc)):
+            topic_heap = []
             for base, percent in model.topic_doc[topic]:
                 if percent == 0.0:
                     continue
                 if base not in self.g:
                     continue
-                self.g.add_edge('concept-' + str(topic), base,
-                                type='topic', weight=percent)
-
-
+                candidates += 1
+                push(topic_heap, (percent, base), topic_doc_edges)
+                if percent >= min_doc_topic_weight:
+                    push(doc_heaps[base], (percent, topic), doc_topic_edges)
+            edges.update(((topic, base), percent)
+                         for percent, base in topic_heap)
+        for base, doc_heap in doc_heaps.items():
+            edges.update(((topic, base), percent)
+                         for percent, topic in doc_heap)
+
+        # Link the concept nodes to documents, in a fixed order so the
+        # graph is the same on every run.
+        for (topic, base), percent in sorted(edges.items()):
+            self.g.add_edge('concept-' + str(topic), base,
+                            type='topic', weight=percent)
+
+        print('Kept %d concept-document edges; dropped %d.' %
+              (len(edges), candidates - len(edges)))
+
+
+    @traced('conceptgraph.add_dependencies')
     def add_dependencies(self, edges):
         print('Adding dependencies to concept graph.')
+        self.cache.clear()
         for t1 in edges:
             for t2 in edges[t1]:
                 if edges[t1][t2] <= 0.0:
@@ -84,7 +158,8 @@ class ConceptGraph:
                 self.g.node[n].get('type', '') == 'document')
 
 
-    def topic_docs(self, topic_id, min_docs=25, max_docs=200, threshold=0.6):
+    def topic_docs(self, topic_id, min_docs=25, max_docs=MAX_TOPIC_DOCS,
+                   threshold=0.6):
         """Return a sorted list of (document_id, weight) pairs for the
         documents that are most relevant to the specified topic_id,
         including the top `min_docs` most relevant, and all others above
@@ -104,15 +179,25 @@ class ConceptGraph:
 
 
     def topic_deps(self, topic_id):
-        """Return a sorted list of (topic_id, weight) pairs for the
-        topics that are most relevant to the specified topic_id."""
+        """Return a sorted tuple of (topic_id, weight) pairs for the
+        topics that are most relevant to the specified topic_id. The tuple
+        is computed once and shared."""
 
-        edges = []
-        for (_, t2, weight) in self.g.edges([topic_id], data='weight'):
-            if self.g.edge[topic_id][t2]['type'] == 'dependency':
-                edges.append((t2, weight))
+        def build():
+            edges = []
+            for (_, t2, weight) in self.g.edges([topic_id], data='weight'):
+                if self.g.edge[topic_id][t2]['type'] == 'dependency':
+                    edges.append((t2, weight))
+            return tuple(sorted(edges, key=lambda x: x[1], reverse=True))
 
-        return sorted(edges, key=lambda x: x[1], reverse=True)
+        return self.memo(('topic_deps', topic_id), build)
+
+
+    def memo(self, key, build):
+        """Return the cached value for the key, building it if needed."""
+        if key not in self.cache:
+            self.cache[key] = build()
+        return self.cache[key]
 
 
     def doc_topic_strength(self, doc_id, topic_id):
@@ -141,53 +226,113 @@ class ConceptGraph:
                 self.g.node[n].get('type', '') == 'concept')
 
 
+    @traced('conceptgraph.load')
     def load(self, fname):
-        j = json.load(open(fname))
+        """Read a concept graph from a JSON file, parsing it a record at a
+        time. Raises ValueError naming the record if the file can't be
+        read."""
+
+        start = time.time()
+        self.cache.clear()
+
+        # Concepts are added as they are read. Documents and other edges
+        # are added after them, in bulk, so the graph is the same whatever
+        # the order of the file.
+        docs = []
+        cites = []
+        deps = []
+        fields = {}
+        num_concepts = 0
+
+        def add_record(path, value):
+            nonlocal num_concepts
+            if path == ('nodes',):
+                words = sorted(((f['feature'], f['count'])
+                                for f in value['featureWeights']),
+                               key=lambda x: (-1.0 * x[1], x[0]))
+                c = value['id']
+                self.g.add_node(c, type='concept', words=words,
+                                name=value['name'],
+                                mentions=value['mentionCount'])
+                # Add the composition edges to the adjacency dicts of the
+                # (NetworkX 1.x) graph directly, as add_edge would.
+                succ = self.g.succ
+                out = succ[c]
+                for e in value['docWeights']:
+                    doc = e['document']
+                    if doc not in succ:
+                        self.g.add_node(doc)
+                    data = out.get(doc)
+                    if data is None:
+                        out[doc] = self.g.pred[doc][c] = \
+                            {'weight': e['weight'], 'type': 'composition'}
+                    else:
+                        data.update(weight=e['weight'], type='composition')
+                num_concepts += 1
+            elif path == ('corpus', 'docs'):
+                docs.append((value['id'],
+                             {'type': 'document',
+                              'authors': [x['fullName']
+                                          for x in value['authors']],
+                              'title': value['title'],
+                              'book': value['book'],
+                              'year': value['year'],
+                              'url': value['url'],
+                              'abstract': value['abstractText'],
+                              'length': value.get('length', 0),
+                              'roles': value.get('roles', {})}))
+                cites.extend((value['id'], cited, {'type': 'cite'})
+                             for cited in value.get('cites', []))
+            elif path == ('edges',):
+                deps.append((value['source'], value['target'],
+                             {'type': value['type'],
+                              'weight': value['weight']}))
 
         try:
-            self.id = j['id']
-            self.provenance = j['provenance']
-            self.type = j['type']
-
-            for c in j['nodes']:
-                self.g.add_node(c['id'], type='concept', words=[])
-                self.g.node[c['id']]['name'] = c['name']
-                self.g.node[c['id']]['mentions'] = c['mentionCount']
-                for f in c['featureWeights']:
-                    self.g.node[c['id']]['words'].append((f['feature'],
-                                                          f['count']))
-                self.g.node[c['id']]['words'].sort(key=lambda x:
-                                                   (-1.0 * x[1], x[0]))
-                for doc_edge in c['docWeights']:
-                    self.g.add_edge(c['id'], doc_edge['document'],
-                                    weight=doc_edge['weight'],
-                                    type='composition')
-
-            for d in j['corpus']['docs']:
-                self.g.add_node(d['id'], type='document',
-                                authors=[x['fullName'] for x in d['authors']],
-                                title=d['title'], book=d['book'],
-                                year=d['year'], url=d['url'],
-                                abstract=d['abstractText'],
-                                length=d.get('length', 0),
-                                roles=d.get('roles', {}))
-                for cited in d.get('cites', []):
-                    self.g.add_edge(d['id'], cited, type='cite')
-
-            for e in j['edges']:
-                self.g.add_edge(e['source'], e['target'], type=e['type'],
-                                weight=e['weight'])
-
-
-        except Exception as e:
-            sys.stderr.write('Error importing concept graph %s.\n' % (fname))
-            print(e, file=sys.stderr)
-            sys.exit(1)
-
-
+            with open(fname, encoding='utf8') as f:
+                for path, i, value in iter_json(f, RECORD_ARRAYS):
+                    if i is None:
+                        fields[path] = value
+                        continue
+                    try:
+                        add_record(path, value)
+                    except (KeyError, TypeError, AttributeError) as e:
+                        if isinstance(e, KeyError):
+                            e = 'missing field %s' % (e)
+                        record = '%s record %d' % ('.'.join(path), i)
+                        if isinstance(value, dict) and 'id' in value:
+                            record += ' (%s)' % (value['id'])
+                        raise ValueError('%s: %s' % (record, e))
+            for field in ['id', 'provenance', 'type']:
+                if (field,) not in fields:
+                    raise ValueError("missing field '%s'" % (field))
+        except (OSError, ValueError) as e:
+            raise ValueError('Error importing concept graph %s: %s' %
+                             (fname, e)) from e
+
+        self.id = fields[('id',)]
+        self.provenance = fields[('provenance',)]
+        self.type = fields[('type',)]
+
+        for doc_id, attrs in docs:
+            self.g.add_node(doc_id, **attrs)
+        self.g.add_edges_from(cites)
+        self.g.add_edges_from(deps)
+
+        elapsed = time.time() - start
+        size = os.path.getsize(fname) / 2**20
+        print('Read concept graph with %d concepts, %d documents, and %d '
+              'edges in %.1f s (%.1f MB/s).' %
+              (num_concepts, len(docs),
+               self.g.number_of_edges(), elapsed,
+               size / elapsed if elapsed else 0.0), file=sys.stderr)
+
+
+    @traced('conceptgraph.export')
     def export(self, file='concept-graph.json', concept_threshold=0.2,
-               provenance=''):
-        """Export the concept graph as a JSON file."""
+               provenance='', compact=False):
+        """Export the concept graph as a JSON file, written as it is
+        generated. The output is indented unless `compact`."""
 
         def bad_topic(c):
             if 'score' in self.g.node[c] and \
@@ -200,67 +345,244 @@ class ConceptGraph:
                 return True
             return False
 
+        concepts = list(self.concepts())
+        bad = set(c for c in concepts if bad_topic(c))
+
+        def concept_nodes():
+            """Generate concept nodes and their (topic model) features."""
+            for c in sorted(set(concepts) - bad):
+                j_concept = {'id': c,
+                             'name': self.g.node[c]['name'],
+                             'mentionCount': self.g.node[c]['mentions'],
+                             'featureWeights': [],
+                             'docWeights': []}
+
+                for (word, weight) in self.g.node[c].get('words', [])[:40]:
+                    if weight < 1:
+                        continue
+                    j_concept['featureWeights'].append({'feature': word,
+                                                        'count': int(weight)})
+
+                for (doc, weight) in self.topic_docs(c):
+                    j_concept['docWeights'].append({'document': doc,
+                                                    'weight': weight})
+                yield j_concept
+
+        def doc_nodes():
+            """Generate document nodes and their features."""
+            for doc_id in sorted(self.docs()):
+                node = self.g.node[doc_id]
+                yield {'id': doc_id,
+                       'url': node['url'],
+                       'title': node['title'],
+                       'authors': [{'fullName': x} for x in node['authors']],
+                       'book': node['book'],
+                       'year': node['year'],
+                       'abstractText': node['abstract'],
+                       'cites': [],  # self.doc_cites(doc_id),
+                       'length': node.get('length', 0),
+                       'roles': node.get('roles', {})}
+
+        # Dependency edges, in the order of the graph so edges with the same
+        # sort key keep their relative order.
+        edges = []
+        for t1 in concepts:
+            if t1 in bad:
+                continue
+            for t2, data in self.g[t1].items():
+                if data.get('type', '') != 'dependency' or t2 in bad:
+                    continue
+                edges.append((t1, t2, data['weight']))
+        edges.sort(key=lambda x: x[0] + x[1])
+
         j = {'id': self.id,
              'provenance': ' '.join([self.provenance, provenance]).strip(),
              'type': self.type,
-             'nodes': [],
-             'edges': [],
+             'nodes': concept_nodes(),
+             'edges': ({'source': t1,
+                        'target': t2,
+                        'weight': weight,
+                        'type': 'dependency'} for (t1, t2, weight) in edges),
              'corpus': {'id': str(uuid.uuid4()),
                         'name': '',
                         'description': '',
-                        'docs': []}}
-
-        # Add concept nodes and their (topic model) features.
-        for c in self.concepts():
-            if bad_topic(c):
-                continue
-
-            j_concept = {'id': c,
-                         'name': self.g.node[c]['name'],
-                         'mentionCount': self.g.node[c]['mentions'],
-                         'featureWeights': [],
-                         'docWeights': []}
-
-            for (word, weight) in self.g.node[c].get('words', [])[:40]:
-                if weight < 1:
-                    continue
-                j_concept['featureWeights'].append({'feature': word,
-                                                    'count': int(weight)})
-
-            for (doc, weight) in self.topic_docs(c):
-                j_concept['docWeights'].append({'document': doc,
-                                                'weight': weight})
-            j['nodes'].append(j_concept)
-
-        j['nodes'].sort(key=lambda x: x['id'])
-
-        # Add document nodes and their features.
-        for doc_id in self.docs():
-            j_doc = {'id': doc_id,
-                     'url': self.g.node[doc_id]['url'],
-                     'title': self.g.node[doc_id]['title'],
-                     'authors': [{'fullName': x}
-                                 for x in self.g.node[doc_id]['authors']],
-                     'book': self.g.node[doc_id]['book'],
-                     'year': self.g.node[doc_id]['year'],
-                     'abstractText': self.g.node[doc_id]['abstract'],
-                     'cites': [],  # self.doc_cites(doc_id),
-                     'length': self.g.node[doc_id].get('length', 0),
-                     'roles': self.g.node[doc_id].get('roles', {})}
-            j['corpus']['docs'].append(j_doc)
-
-        j['corpus']['docs'].sort(key=lambda x: x['id'])
-
-        for (t1, t2, data) in self.g.edges(data=True):
-            if data.get('type', '') != 'dependency':
-                continue
-            if bad_topic(t1) or bad_topic(t2):
-                continue
-            j['edges'].append({'source': t1,
-                               'target': t2,
-                               'weight': data['weight'],
-                               'type': 'dependency'})
-        j['edges'].sort(key=lambda x: x['source'] + x['target'])
-
-        json.dump(j, open(file, 'w', encoding='utf8'), indent=1,
-                  sort_keys=True, ensure_ascii=False)
+                        'docs': doc_nodes()}}
+
+        with open(file, 'w', encoding='utf8') as out:
+            write_json(out, j, None if compact else 1)
+
+
+def write_json(out, value, indent=None, level=0):
+    """Write the value as JSON with sorted keys, the same as json.dump, but
+    writing the items of any generators in it as they are produced. The
+    output is indented by `indent` spaces per level, or else compact."""
+
+    if indent is None:
+        item_sep, key_sep = ',', ':'
+        newline = ''
+    else:
+        item_sep, key_sep = ',', ': '
+        newline = '\n' + ' ' * (indent * (level + 1))
+
+    if isinstance(value, dict):
+        if not value:
+            out.write('{}')
+            return
+        out.write('{')
+        for i, key in enumerate(sorted(value)):
+            if i:
+                out.write(item_sep)
+            out.write(newline + json.dumps(key, ensure_ascii=False) + key_sep)
+            write_json(out, value[key], indent, level + 1)
+        out.write(newline[:-indent] if indent else '')
+        out.write('}')
+    elif isinstance(value, types.GeneratorType):
+        empty = True
+        for item in value:
+            out.write(item_sep if not empty else '[')
+            empty = False
+            s = json.dumps(item, indent=indent, separators=(item_sep, key_sep),
+                           sort_keys=True, ensure_ascii=False)
+            if indent:
+                s = s.replace('\n', newline)
+            out.write(newline + s)
+        if empty:
+            out.write('[]')
+        else:
+            out.write((newline[:-indent] if indent else '') + ']')
+    else:
+        s = json.dumps(value, indent=indent, separators=(item_sep, key_sep),
+                       sort_keys=True, ensure_ascii=False)
+        if indent:
+            s = s.replace('\n', '\n' + ' ' * (indent * level))
+        out.write(s)
+
+
+class JSONStream:
+    """Read JSON values from a text file a chunk at a time, keeping only the
+    unread part of the file in memory."""
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        """Read more of the file into the buffer, returning False at the
+        end of the file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character that isn't whitespace, or '' at the
+        end of the file."""
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise self.error('Expecting ' +
+                             ' or '.join("'%s'" % (x) for x in chars))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Return the next complete value."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A bare number that runs to the end of the buffer might
+                # continue, even if a shorter number was decoded, e.g., 0
+                # from '0.' or 1 from '1e'.
+                if self.eof or \
+                   NUMBER_RE.match(self.buf, self.pos).end() < len(self.buf):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError('%s at character %d' %
+                                     (e.msg, self.offset + e.pos))
+            # Read larger chunks for long values, so they aren't decoded
+            # again too many times.
+            self.fill(size)
+            size *= 2
+
+    def items(self):
+        """Yield the items of the array at the current position."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            # Skip the separator and any whitespace around it at once.
+            m = ITEM_END_RE.match(self.buf, self.pos)
+            if m and m.end() < len(self.buf):
+                self.pos = m.end()
+                if m.group(1) == ']':
+                    return
+            elif self.expect(',]') == ']':
+                return
+
+    def error(self, msg):
+        return ValueError('%s at character %d' %
+                          (msg, self.offset + self.pos))
+
+
+def iter_json(f, arrays):
+    """Yield (path, index, value) for each item of an array at one of the
+    `arrays` paths in the JSON object read from the file, and (path, None,
+    value) for each other value in it. Paths are tuples of keys."""
+
+    s = JSONStream(f)
+    s.expect('{')
+    yield from iter_object(s, (), arrays)
+    if s.peek():
+        raise s.error('Extra data')
+
+
+def iter_object(s, path, arrays):
+    if s.peek() == '}':
+        s.pos += 1
+        return
+    while True:
+        if s.peek() != '"':
+            raise s.error('Expecting property name')
+        key = s.value()
+        s.expect(':')
+        p = path + (key,)
+        if p in arrays and s.peek() == '[':
+            i = 0
+            try:
+                for item in s.items():
+                    yield p, i, item
+                    i += 1
+            except ValueError as e:
+                raise ValueError('%s record %d: %s' % ('.'.join(p), i, e))
+        elif any(a[:len(p)] == p for a in arrays) and s.peek() == '{':
+            s.pos += 1
+            yield from iter_object(s, p, arrays)
+        else:
+            yield p, None, s.value()
+        if s.expect(',}') == '}':
+            return
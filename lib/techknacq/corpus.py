@@ -5,12 +5,17 @@ import sys
 import os
 import io
 import json
+import codecs
+import time
 import datetime
 import re
 import multiprocessing as mp
+import numpy as np
 import enchant
 import ftfy
 
+from array import array
+from itertools import accumulate
 from pathlib import Path
 from bs4 import BeautifulSoup
 from xml.sax.saxutils import escape
@@ -18,39 +23,83 @@ from unidecode import unidecode
 from nltk import bigrams
 
 from techknacq.lx import SentTokenizer, StopLexicon, find_short_long_pairs
+from techknacq.instrument import span, record, count
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BIOC_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE collection SYSTEM "BioC.dtd">
+<collection>
+<source>TechKnAcq</source>
+<key>techknacq.key</key>
+'''
+BIOC_FOOTER = '</collection>'
+
+# Pedagogical roles, in the order of columns in the roles file.
+ROLES = ['survey', 'tutorial', 'resource', 'reference', 'empirical', 'manual',
+         'other']
+
+ROLES_PATH = 'data/pedagogical-roles.txt'
+
+# Prior role weights for documents from each source, in the order of ROLES.
+ROLE_PRIORS = {
+    'wiki': np.array([0.2, 0.0, 0.0, 0.8, 0.0, 0.0, 0.0]),
+    'tutorial': np.array([0.1, 0.6, 0.0, 0.0, 0.0, 0.2, 0.1]),
+    'acl': np.array([0.0, 0.0, 0.1, 0.0, 0.8, 0.0, 0.1]),
+    'sd': np.array([0.1, 0.1, 0.0, 0.7, 0.0, 0.0, 0.1])
+}
+NO_PRIOR = np.full(len(ROLES), np.nan)
+
+# Document ID prefixes removed to match IDs in the roles file.
+ID_PREFIXES = {'acl', 'wiki', 'sd', 'web'}
 
 class Corpus:
     def __init__(self, path=None, pool=None):
         self.docs = {}
 
+        # The rendered citation snippet (authors and title) of each cited
+        # document, by document ID and form.
+        self.snippets = {}
+
         if path and os.path.isfile(path):
             # Read a BioC corpus file.
-            j = json.load(open(path))
-            for d in j['documents']:
-                doc = Document()
-                doc.read_bioc_json(d)
-                self.add(doc)
+            with span('corpus.load', path=path):
+                j = json.load(open(path))
+                for d in j['documents']:
+                    with span('document.parse'):
+                        doc = Document()
+                        doc.read_bioc_json(d)
+                    self.add(doc)
+            count('corpus.documents', len(self.docs))
         elif path:
             if not pool:
                 pool = mp.Pool(int(.5 * mp.cpu_count()))
 
-            docnames = (str(f) for f in Path(path).iterdir() if f.is_file())
-            for doc in pool.imap(Document, docnames):
-                if doc:
-                    self.add(doc)
+            with span('corpus.load', path=path):
+                docnames = (str(f) for f in Path(path).iterdir()
+                            if f.is_file())
+                for doc, elapsed in pool.imap(read_document, docnames):
+                    record('document.parse', elapsed)
+                    if doc:
+                        self.add(doc)
+            count('corpus.documents', len(self.docs))
             print('Read %d documents.' % len(self.docs))
 
-        if os.path.exists('data/pedagogical-roles.txt'):
-            print('Loading pedagogical roles.')
-            self.read_roles('data/pedagogical-roles.txt')
 
     def clear(self):
         self.docs = {}
+        self.snippets = {}
 
     def add(self, doc):
         assert(type(doc) == Document)
+        doc.pack()
         doc.corpus = self
         self.docs[doc.id] = doc
+        self.snippets.pop(doc.id, None)
 
     def __ior__(self, other):
         for doc in other:
@@ -66,19 +115,72 @@ class Corpus:
 
     def __setitem__(self, key, item):
         self.docs[key] = item
+        self.snippets.pop(key, None)
 
     def __contains__(self, key):
         return key in self.docs
 
+    def citation_text(self, doc_id):
+        """Return the authors and title of the document as they appear in
+        the text of documents citing it."""
+        forms = self.snippets.setdefault(doc_id, {})
+        if 'text' not in forms:
+            doc = self.docs[doc_id]
+            out = ['\n']
+            for author in doc.authors:
+                if author == 'Wikipedia':
+                    continue
+                out += [author, '.\n']
+            out += [doc.title, '.\n']
+            forms['text'] = filter_non_printable(unidecode(''.join(out)))
+        return forms['text']
+
+    def citation_bigrams(self, doc_id, stop):
+        """Return the bigrams of the authors and title of the document as
+        they appear in the bigrams of documents citing it."""
+        forms = self.snippets.setdefault(doc_id, {})
+        # The key holds the stoplist itself, not its id(), which could be
+        # reused by another stoplist once this one is freed.
+        key = ('bigrams', stop)
+        if key not in forms:
+            doc = self.docs[doc_id]
+            out = []
+            for author in doc.authors:
+                if author == 'Wikipedia':
+                    continue
+                sent_bigrams(author, stop, out)
+            sent_bigrams(doc.title, stop, out)
+            forms[key] = ''.join(out)
+        return forms[key]
+
     def fix_text(self):
         for doc in self:
             doc.dehyphenate()
             #doc.expand_short_forms()
+            doc.pack()
+
+    def export(self, dest, abstract=False, form='json', compact=False,
+               collection=False):
+        """Write each document to a file in the directory `dest`. JSON is
+        written without indentation if `compact`. With `collection`, BioC
+        documents are written as a single collection to the file
+        `dest`."""
 
-    def export(self, dest, abstract=False, form='json'):
         if form not in ['json', 'bioc', 'text', 'bigrams']:
             print('Unrecognized form for export', form, file=sys.stderr)
             sys.exit(1)
+        if collection and form != 'bioc':
+            print('Only BioC can be exported as a collection.',
+                  file=sys.stderr)
+            sys.exit(1)
+
+        if collection:
+            with io.open(dest, 'w', encoding='utf-8') as out:
+                write_bioc_header(out)
+                for d in self:
+                    d.write_bioc_document(out, abstract)
+                out.write(BIOC_FOOTER + '\n')
+            return
 
         if form == 'bigrams':
             stop = StopLexicon()
@@ -87,11 +189,13 @@ class Corpus:
             if form == 'json':
                 with io.open(os.path.join(dest, d.id + '.json'), 'w',
                              encoding='utf-8') as out:
-                    out.write(d.json(abstract) + '\n')
+                    d.write_json(out, abstract, compact)
+                    out.write('\n')
             elif form == 'bioc':
                 with io.open(os.path.join(dest, d.id + '.xml'), 'w',
                              encoding='utf-8') as out:
-                    out.write(d.bioc(abstract) + '\n')
+                    d.write_bioc(out, abstract)
+                    out.write('\n')
             elif form == 'text':
                 with io.open(os.path.join(dest, d.id + '.txt'), 'w',
                              encoding='utf-8') as out:
@@ -102,78 +206,59 @@ class Corpus:
                     out.write(d.bigrams(abstract, stop) + '\n')
 
 
-    def read_roles(self, fname):
-        role_annotations = {}
-        for line in open(fname):
-            if line.startswith('doc_id'):
-                continue
-            vals = line.strip().split('\t')
-            doc_id = vals[0]
-            role_annotations[doc_id.lower()] = \
-              {'survey': float(vals[1]),
-               'tutorial': float(vals[2]),
-               'resource': float(vals[3]),
-               'reference': float(vals[4]),
-               'empirical': float(vals[5]),
-               'manual': float(vals[6]),
-               'other': float(vals[7])}
-        for doc in self:
-            prior = None
-            if doc.id.startswith('wiki-'):
-                prior = {'survey': 0.2,
-                         'tutorial': 0.0,
-                         'resource': 0.0,
-                         'reference': 0.8,
-                         'empirical': 0.0,
-                         'manual': 0.0,
-                         'other': 0.0}
-            elif doc.id.startswith('web-') or 'Tutorials' in doc.book:
-                prior = {'survey': 0.1,
-                         'tutorial': 0.6,
-                         'resource': 0.0,
-                         'reference': 0.0,
-                         'empirical': 0.0,
-                         'manual': 0.2,
-                         'other': 0.1}
-            elif doc.id.startswith('acl-'):
-                prior = {'survey': 0.0,
-                         'tutorial': 0.0,
-                         'resource': 0.1,
-                         'reference': 0.0,
-                         'empirical': 0.8,
-                         'manual': 0.0,
-                         'other': 0.1}
-            elif doc.id.startswith('sd-'):
-                prior = {'survey': 0.1,
-                         'tutorial': 0.1,
-                         'resource': 0.0,
-                         'reference': 0.7,
-                         'empirical': 0.0,
-                         'manual': 0.0,
-                         'other': 0.1}
-
-            short_id = re.sub('^(acl|wiki|sd|web)-', '', doc.id.lower())
-            annotation = role_annotations.get(short_id)
-
-            if prior and annotation:
-                doc.roles = {}
-                for role in prior:
-                    doc.roles[role] = (prior[role] + annotation[role]) / 2.0
-            elif annotation:
-                doc.roles = annotation
-            elif prior:
-                doc.roles = prior
-            else:
-                doc.roles = {'survey': 0.0,
-                             'tutorial': 0.0,
-                             'resource': 0.0,
-                             'reference': 0.0,
-                             'empirical': 0.0,
-                             'manual': 0.0,
-                             'other': 0.0}
+    def read_roles(self, fname=ROLES_PATH):
+        """Set the pedagogical roles of each document by averaging the
+        annotations in the roles file with a prior for the document's
+        source, or using whichever of them is available."""
+
+        index, annotations = load_roles(fname)
+
+        docs = list(self)
+        rows = np.array([index.get(short_id(doc.id), -1) for doc in docs],
+                        dtype=int)
+        priors = np.array([role_prior(doc) for doc in docs]).reshape(
+            len(docs), len(ROLES))
+
+        has_annotation = rows >= 0
+        has_prior = ~np.isnan(priors[:, 0])
+        weights = np.where(has_prior[:, None], priors, 0.0)
+        weights[has_annotation] += annotations[rows[has_annotation]]
+        weights[has_prior & has_annotation] /= 2.0
+
+        for doc, w in zip(docs, weights):
+            doc.role_weights = array('d', w)
 
 
 class Document:
+    """A document's metadata and text. To save memory in large corpora,
+    the sentences of all sections are stored in one UTF-8 buffer with an
+    array of offsets, author names and book titles are interned, and roles
+    are an array of weights in the order of ROLES.
+
+    The `sections` and `roles` attributes are views of this compact form.
+    Reading `sections` unpacks them into a list of dicts, each with an
+    optional 'heading' and a list of sentences as 'text', which can be
+    modified in place until pack() is called. Adding the document to a
+    Corpus packs it.
+
+    The text and bigrams of a packed document are cached once built, until
+    its sections are read for modification, it is packed again, or its
+    authors, title, book, or year are assigned. Assigning its authors or
+    title also clears its citation snippets in the corpus. Modifying the
+    authors list in place, or the sections after the document is packed,
+    doesn't clear the cache and isn't supported."""
+
+    __slots__ = ['id', 'authors', 'title', 'book', 'year', 'url',
+                 'references', 'corpus', 'unpacked', 'text_buffer',
+                 'offsets', 'section_ends', 'headings', 'role_weights',
+                 'cache']
+
+    # Attributes the cached text is built from.
+    text_attrs = frozenset(['authors', 'title', 'book', 'year'])
+
+    # Attributes the corpus's citation snippets are built from.
+    citation_attrs = frozenset(['authors', 'title'])
+
     def __init__(self, fname=None, form=None):
         if fname and not form:
             if 'json' in fname:
@@ -195,7 +280,7 @@ class Document:
         if 'id' in j['info']:
             self.id = j['info']['id']
         else:
-            basename = os.path.basename(fname)
+            basename = os.path.basename(fname or '')
             basename = re.sub('\.(json|xml|txt)$', '', basename)
             self.id = basename
         self.authors = [x.strip() for x in j['info'].get('authors', [])]
@@ -204,15 +289,127 @@ class Document:
         self.year = j['info'].get('year', '')
         self.url = j['info'].get('url', '')
         self.references = set(j.get('references', []))
-        self.sections = j.get('sections', [])
-        self.roles = {}
+        self.text_buffer = b''
+        self.offsets = array('I', [0])
+        self.section_ends = array('I')
+        self.headings = ()
+        self.unpacked = j.get('sections', [])
+        self.role_weights = None
+        self.cache = None
         self.corpus = None
 
         if fname and form == 'text':
             st = SentTokenizer()
             self.sections = [{'text': st.tokenize(open(fname).read())}]
         elif fname and form == 'sd':
-            self.read_sd(fname)
+            try:
+                self.read_sd(fname)
+            except ValueError as e:
+                print(' !', e)
+        self.pack()
+
+
+    def __getstate__(self):
+        self.pack()
+        state = {x: getattr(self, x) for x in self.__slots__}
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        for x in state:
+            setattr(self, x, state[x])
+
+    def __setattr__(self, name, value):
+        if name in Document.text_attrs:
+            object.__setattr__(self, 'cache', None)
+        if name in Document.citation_attrs:
+            corpus = getattr(self, 'corpus', None)
+            if corpus is not None:
+                corpus.snippets.pop(self.id, None)
+        object.__setattr__(self, name, value)
+
+
+    @property
+    def sections(self):
+        # The caller may modify the sections.
+        self.cache = None
+        if self.unpacked is None:
+            self.unpacked = self.section_dicts()
+        return self.unpacked
+
+    @sections.setter
+    def sections(self, sections):
+        self.cache = None
+        self.unpacked = sections
+
+    @property
+    def roles(self):
+        if self.role_weights is None:
+            return {}
+        return dict(zip(ROLES, self.role_weights))
+
+    @roles.setter
+    def roles(self, roles):
+        if roles:
+            self.role_weights = array('d', [roles.get(x, 0.0)
+                                            for x in ROLES])
+        else:
+            self.role_weights = None
+
+
+    def pack(self):
+        """Store the sections, authors, book, and references compactly."""
+        self.cache = None
+        if self.unpacked is not None:
+            headings = []
+            sents = []
+            ends = array('I')
+            for sect in self.unpacked:
+                headings.append(sect.get('heading'))
+                sents.extend(x.encode('utf-8') for x in sect['text'])
+                ends.append(len(sents))
+            self.text_buffer = b''.join(sents)
+            self.offsets = array('I', accumulate(map(len, sents), initial=0))
+            self.section_ends = ends
+            self.headings = tuple(headings)
+            self.unpacked = None
+        self.authors = [sys.intern(x) for x in self.authors]
+        self.book = sys.intern(self.book)
+        self.references = tuple(sorted(set(sys.intern(x) for x in
+                                           self.references)))
+
+    def memo(self, key, build):
+        """Return the cached value for the key, building it if needed.
+        Nothing is cached while the sections are unpacked, since they can
+        still be modified."""
+        if self.unpacked is not None:
+            return build()
+        if self.cache is None:
+            self.cache = {}
+        if key not in self.cache:
+            self.cache[key] = build()
+        return self.cache[key]
+
+    def sentence(self, i):
+        """Return the i-th sentence of the packed sections."""
+        return self.text_buffer[self.offsets[i]:
+                                self.offsets[i+1]].decode('utf-8')
+
+    def section_dicts(self):
+        """Return the sections as a list of dicts, without unpacking the
+        document."""
+        if self.unpacked is not None:
+            return self.unpacked
+        sections = []
+        start = 0
+        for heading, end in zip(self.headings, self.section_ends):
+            sect = {}
+            if heading is not None:
+                sect['heading'] = heading
+            sect['text'] = [self.sentence(i) for i in range(start, end)]
+            sections.append(sect)
+            start = end
+        return sections
 
 
     def read_bioc_json(self, j):
@@ -252,7 +449,8 @@ class Document:
 
 
     def read_sd(self, f, fref=None):
-        """Read document contents from a ScienceDirect XML file."""
+        """Read document contents from a ScienceDirect XML file, raising
+        ValueError if it has no PII or too little text."""
 
         def get_para_sents(p):
             if p.find('list'):
@@ -282,8 +480,7 @@ class Document:
         try:
             pii = re.sub('[()-.]', '', soup.find('pii').string)
         except:
-            print('No PII found for', f)
-            return
+            raise ValueError('No PII found for ' + f)
 
         self.id = 'sd-' + pii.lower()
         self.authors = []
@@ -351,8 +548,8 @@ class Document:
             self.sections.append({'text': st.tokenize(soup.rawtext.get_text())})
 
         if len(self.text()) < 200:
-            print(' ! Skip:', self.title, self.id + '. Missing text.')
-            return
+            raise ValueError('Skip: %s %s. Missing text.' % (self.title,
+                                                            self.id))
 
         if not fref:
             fref = f.replace('-full.xml', '-ref.xml')
@@ -443,21 +640,26 @@ class Document:
     def get_abstract(self):
         """Return the (probable) abstract for the document."""
 
-        if self.sections[0].get('heading', '') == 'Abstract':
-            return self.sections[0]['text'][:10]
-        if len(self.sections) > 1 and \
-           self.sections[1].get('heading', '') == 'Abstract':
-            return self.sections[1]['text'][:10]
+        sections = self.section_dicts()
+        if sections[0].get('heading', '') == 'Abstract':
+            return sections[0]['text'][:10]
+        if len(sections) > 1 and \
+           sections[1].get('heading', '') == 'Abstract':
+            return sections[1]['text'][:10]
 
-        if len(self.sections[0]['text']) > 2:
-            return self.sections[0]['text'][:10]
-        if len(self.sections) > 1 and len(self.sections[1]['text']) > 2:
-            return self.sections[1]['text'][:10]
-        return self.sections[0]['text'][:10]
+        if len(sections[0]['text']) > 2:
+            return sections[0]['text'][:10]
+        if len(sections) > 1 and len(sections[1]['text']) > 2:
+            return sections[1]['text'][:10]
+        return sections[0]['text'][:10]
 
 
-    def json(self, abstract=False):
+    def json(self, abstract=False, compact=False):
         """Return a JSON string representing the document."""
+        return dumps_json(self.json_value(abstract), compact)
+
+    def json_value(self, abstract=False):
+        """Return the dict written as the document's JSON."""
 
         doc = {
             'info': {
@@ -471,136 +673,296 @@ class Document:
             'references': sorted(list(self.references))
         }
         if abstract:
-            doc['sections'] = [self.sections[0]]
+            doc['sections'] = self.section_dicts()[:1]
         else:
-            doc['sections'] = self.sections
+            doc['sections'] = self.section_dicts()
+
+        return doc
 
-        return json.dumps(doc, indent=2, sort_keys=True, ensure_ascii=False)
+    def write_json(self, out, abstract=False, compact=False):
+        """Write the document as JSON to the text file handle, as by
+        dump_json."""
+        dump_json(self.json_value(abstract), out, compact)
 
 
     def bioc(self, abstract=False):
         """Return a BioC XML string representing the document."""
-
-        t = '''<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE collection SYSTEM "BioC.dtd">
-<collection>
-<source>TechKnAcq</source>
-<key>techknacq.key</key>
-'''
-        t += '<date>' + datetime.date.today().isoformat() + '</date>'
-        t += '<document>'
-        t += '<id>' + escape(self.id) + '</id>'
-        t += '<passage><offset>0</offset>'
-        t += '<infon key="authors">'
-        t += escape('; '.join(self.authors)) + '</infon>'
-        t += '<infon key="title">' + escape(self.title) + '</infon>'
-        t += '<infon key="year">' + escape(str(self.year)) + '</infon>'
-        t += '<infon key="book">' + escape(self.book) + '</infon>'
-        t += '<infon key="url">' + escape(self.url) + '</infon>'
-        t += '<text>'
-        for s in self.sections:
+        out = io.StringIO()
+        self.write_bioc(out, abstract)
+        return out.getvalue()
+
+    def write_bioc(self, out, abstract=False):
+        """Write the document as a BioC XML collection to the file
+        handle."""
+        write_bioc_header(out)
+        self.write_bioc_document(out, abstract)
+        out.write(BIOC_FOOTER)
+
+    def write_bioc_document(self, out, abstract=False):
+        """Write the BioC XML document element to the file handle, for
+        inclusion in a collection."""
+
+        def write(s):
+            out.write(filter_non_printable(s))
+
+        write('<document><id>' + escape(self.id) + '</id>'
+              '<passage><offset>0</offset>'
+              '<infon key="authors">' + escape('; '.join(self.authors)) +
+              '</infon>'
+              '<infon key="title">' + escape(self.title) + '</infon>'
+              '<infon key="year">' + escape(str(self.year)) + '</infon>'
+              '<infon key="book">' + escape(self.book) + '</infon>'
+              '<infon key="url">' + escape(self.url) + '</infon>'
+              '<text>')
+        sections = self.section_dicts()
+        for s in sections:
             if s.get('heading'):
-                t += escape(s['heading']) + ' '
-            t += escape(' '.join(s['text']))
-            if s != self.sections[-1]:
-                t += ' '
+                write(escape(s['heading']) + ' ')
+            write(escape(' '.join(s['text'])))
+            if s != sections[-1]:
+                out.write(' ')
             if abstract:
                 break
-        t += '</text>'
-        t += '</passage></document></collection>'
-        return filter_non_printable(t)
+        out.write('</text></passage></document>')
 
 
     def text(self, abstract=False):
         """Return a plain-text string representing the document."""
-        out = self.title + '.\n'
-        out += self.title + '.\n'
+        return self.memo(('text', abstract),
+                         lambda: self.text_body(abstract)) + \
+               self.citation_text()
+
+    def text_body(self, abstract=False):
+        out = [self.title, '.\n', self.title, '.\n']
 
         for author in self.authors:
             if author == 'Wikipedia':
                 continue
-            out += author + '.\n'
+            out += [author, '.\n']
 
-        out += self.book + '\n' + str(self.year) + '\n\n'
+        out += [self.book, '\n', str(self.year), '\n\n']
 
         if abstract:
-            out += '\n'.join(self.get_abstract())
+            out.append('\n'.join(self.get_abstract()))
         else:
-            for sect in self.sections:
+            for sect in self.section_dicts():
                 if 'heading' in sect and sect['heading']:
-                    out += '\n\n' + sect['heading'] + '\n\n'
-                out += '\n'.join(sect['text']) + '\n'
-
-        for ref_id in sorted(list(self.references)):
-            if not ref_id in self.corpus:
-                continue
-            out += '\n'
-            for author in self.corpus[ref_id].authors:
-                if author == 'Wikipedia':
-                    continue
-                out += author + '.\n'
-            out += self.corpus[ref_id].title + '.\n'
-        return filter_non_printable(unidecode(out))
+                    out += ['\n\n', sect['heading'], '\n\n']
+                out += ['\n'.join(sect['text']), '\n']
+
+        return filter_non_printable(unidecode(''.join(out)))
+
+    def citation_text(self):
+        """Return the authors and titles of the documents this one cites,
+        as plain text."""
+        if self.corpus is None:
+            return ''
+        return ''.join(self.corpus.citation_text(x)
+                       for x in sorted(self.references) if x in self.corpus)
+
+
+    def word_count(self):
+        """Return the number of words in the document's text, counted
+        without building it. This can differ slightly from the number of
+        words in text() where transliteration adds spaces."""
+
+        n = 2 * max(len(self.title.split()), 1)
+        n += sum(len(x.split()) for x in self.authors if x != 'Wikipedia')
+        n += len(self.book.split()) + len(str(self.year).split())
+        if self.unpacked is None:
+            # Split decoded sentences, since bytes.split() doesn't split on
+            # non-ASCII whitespace.
+            n += sum(len(self.sentence(i).split())
+                     for i in range(len(self.offsets) - 1))
+            n += sum(len(x.split()) for x in self.headings if x)
+        else:
+            for sect in self.unpacked:
+                n += len((sect.get('heading') or '').split())
+                n += sum(len(x.split()) for x in sect['text'])
+        if self.corpus is not None:
+            for ref_id in self.references:
+                if ref_id in self.corpus:
+                    n += len(self.corpus.citation_text(ref_id).split())
+        return n
 
 
     def bigrams(self, abstract=False, stop=StopLexicon()):
-        def good_word(w):
-            if '_' in w and not '#' in w:
-                return False
-            return any(c.isalpha() for c in w)
-
-        def bigrams_from_sent(s):
-            s = unidecode(s)
-            ret = ''
-            words = []
-            for x in re.split(r'[^a-zA-Z0-9_#-]+', s):
-                if len(x) > 0 and not x in stop and not x.lower() in stop \
-                   and re.search('[a-zA-Z0-9]', x):
-                    words.append(x)
-            for w1, w2 in bigrams(words):
-                if good_word(w1) and good_word(w2):
-                    ret += w1.lower() + '_' + w2.lower() + '\n'
-                if w1[0] == '#' and w1[-1] == '#' and good_word(w1):
-                    ret += w1 + '\n'
-            if words and words[-1][0] == '#' and words[-1][-1] == '#' and \
-               good_word(words[-1]):
-                ret += words[-1] + '\n'
-            return ret
-
-        out = bigrams_from_sent(self.title)
-        out += bigrams_from_sent(self.title)
+        """Return the bigrams (and entities) of the document's text, one
+        per line, omitting stopwords."""
+        # The key holds the stoplist itself, not its id(), which could be
+        # reused by another stoplist once this one is freed.
+        return self.memo(('bigrams', abstract, stop),
+                         lambda: self.bigrams_body(abstract, stop)) + \
+               self.citation_bigrams(stop)
+
+    def bigrams_body(self, abstract, stop):
+        out = []
+        sent_bigrams(self.title, stop, out)
+        sent_bigrams(self.title, stop, out)
 
         for author in self.authors:
             if author == 'Wikipedia':
                 continue
-            out += bigrams_from_sent(author)
+            sent_bigrams(author, stop, out)
 
-        out += bigrams_from_sent(self.book)
+        sent_bigrams(self.book, stop, out)
 
         if abstract:
             for sent in self.get_abstract():
-                out += bigrams_from_sent(sent)
+                sent_bigrams(sent, stop, out)
         else:
-            for sect in self.sections:
+            for sect in self.section_dicts():
                 if 'heading' in sect and sect['heading']:
-                    out += bigrams_from_sent(sect['heading'])
+                    sent_bigrams(sect['heading'], stop, out)
                 for sent in sect['text']:
-                    out += bigrams_from_sent(sent)
-
-        for ref_id in sorted(list(self.references)):
-            if not ref_id in self.corpus:
+                    sent_bigrams(sent, stop, out)
+
+        return ''.join(out)
+
+    def citation_bigrams(self, stop):
+        """Return the bigrams of the authors and titles of the documents
+        this one cites."""
+        if self.corpus is None:
+            return ''
+        return ''.join(self.corpus.citation_bigrams(x, stop)
+                       for x in sorted(self.references) if x in self.corpus)
+
+
+def read_document(fname):
+    """Return the Document read from the file and the seconds it took, so
+    documents parsed in worker processes can still be timed."""
+    start = time.perf_counter()
+    doc = Document(fname)
+    return doc, time.perf_counter() - start
+
+
+def load_roles(fname=ROLES_PATH):
+    """Return a dict from each lowercase document ID in the roles file to
+    its row in a (documents x roles) matrix of role annotations. The file
+    is only read again if it has changed."""
+    key = (os.path.abspath(fname), os.path.getmtime(fname))
+    if key not in loaded_roles:
+        print('Loading pedagogical roles.')
+        index = {}
+        rows = []
+        for line in open(fname):
+            if line.startswith('doc_id'):
                 continue
-            for author in self.corpus[ref_id].authors:
-                if author == 'Wikipedia':
-                    continue
-                out += bigrams_from_sent(author)
-            out += bigrams_from_sent(self.corpus[ref_id].title)
-
-        return out
-
+            vals = line.strip().split('\t')
+            index[vals[0].lower()] = len(rows)
+            rows.append(vals[1:len(ROLES)+1])
+        loaded_roles.clear()
+        loaded_roles[key] = (index, np.array(rows, dtype=float).reshape(
+            len(rows), len(ROLES)))
+    return loaded_roles[key]
+
+loaded_roles = {}
+
+def short_id(doc_id):
+    """Return the document ID without its source prefix, as used in the
+    roles file."""
+    doc_id = doc_id.lower()
+    prefix, sep, rest = doc_id.partition('-')
+    if sep and prefix in ID_PREFIXES:
+        return rest
+    return doc_id
+
+def role_prior(doc):
+    """Return the prior role weights for the document's source, or NaNs if
+    there's no prior for it."""
+    if doc.id.startswith('wiki-'):
+        return ROLE_PRIORS['wiki']
+    elif doc.id.startswith('web-') or 'Tutorials' in doc.book:
+        return ROLE_PRIORS['tutorial']
+    elif doc.id.startswith('acl-'):
+        return ROLE_PRIORS['acl']
+    elif doc.id.startswith('sd-'):
+        return ROLE_PRIORS['sd']
+    return NO_PRIOR
+
+
+def good_bigram_word(w):
+    if '_' in w and not '#' in w:
+        return False
+    return any(c.isalpha() for c in w)
+
+
+BIGRAM_SPLIT_RE = re.compile(r'[^a-zA-Z0-9_#-]+')
+ALNUM_RE = re.compile('[a-zA-Z0-9]')
+
+def sent_bigrams(s, stop, out):
+    """Append the lines of lowercased bigrams and entities (#...#) in the
+    sentence to the list `out`."""
+    s = unidecode(s)
+    words = []
+    for x in BIGRAM_SPLIT_RE.split(s):
+        if len(x) > 0 and not x in stop and not x.lower() in stop \
+           and ALNUM_RE.search(x):
+            words.append(x)
+    for w1, w2 in bigrams(words):
+        if good_bigram_word(w1) and good_bigram_word(w2):
+            out.append(w1.lower() + '_' + w2.lower() + '\n')
+        if w1[0] == '#' and w1[-1] == '#' and good_bigram_word(w1):
+            out.append(w1 + '\n')
+    if words and words[-1][0] == '#' and words[-1][-1] == '#' and \
+       good_bigram_word(words[-1]):
+        out.append(words[-1] + '\n')
+
+
+# Translation table deleting control characters other than tab and newline.
+NON_PRINTABLE = {i: None for i in range(32) if i not in [9, 10]}
+
+def dumps_json(j, compact=False):
+    """Return the JSON string for the value with sorted keys, indented
+    unless `compact`, using orjson if it's installed."""
+    data = orjson_bytes(j, compact)
+    if data is not None:
+        return data.decode('utf-8')
+    return json.dumps(j, **json_options(compact))
+
+def dump_json(j, out, compact=False):
+    """Write the JSON for the value, as by dumps_json, to the text file
+    handle. Without orjson, it's written in pieces as it's encoded. orjson
+    encodes the whole value at once, and its bytes are written directly to
+    the handle's binary buffer if it's UTF-8."""
+    data = orjson_bytes(j, compact)
+    if data is None:
+        json.dump(j, out, **json_options(compact))
+        return
+    buf = getattr(out, 'buffer', None)
+    if buf is not None and codecs.lookup(out.encoding).name == 'utf-8':
+        out.flush()
+        buf.write(data)
+    else:
+        out.write(data.decode('utf-8'))
+
+def orjson_bytes(j, compact):
+    """Return the JSON for the value as UTF-8 bytes from orjson, or None
+    if it isn't installed or can't encode the value. orjson rejects
+    strings with lone surrogates, which json writes as they are, so these
+    fall back to json and the output doesn't depend on orjson."""
+    if not orjson:
+        return None
+    option = orjson.OPT_SORT_KEYS
+    if not compact:
+        option |= orjson.OPT_INDENT_2
+    try:
+        return orjson.dumps(j, option=option)
+    except orjson.JSONEncodeError:
+        return None
+
+def json_options(compact):
+    if compact:
+        return {'separators': (',', ':'), 'sort_keys': True,
+                'ensure_ascii': False}
+    return {'indent': 2, 'sort_keys': True, 'ensure_ascii': False}
+
+def write_bioc_header(out):
+    out.write(BIOC_HEADER)
+    out.write('<date>' + datetime.date.today().isoformat() + '</date>')
 
 def filter_non_printable(s):
-    return ''.join([c for c in s if ord(c) > 31 or ord(c) == 9 or c == '\n'])
+    return s.translate(NON_PRINTABLE)
 
 def title_case(s):
     for word in ['And', 'The', 'Of', 'From', 'To', 'In', 'For', 'A', 'An',
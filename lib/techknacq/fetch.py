@@ -0,0 +1,253 @@
+# TechKnAcq: Fetch
+# Jonathan Gordon
+
+import sys
+import os
+import time
+import json
+import asyncio
+import aiohttp
+
+from urllib.parse import urlsplit
+
+
+# Parameters
+
+# Requests per second allowed for each host. Others use DEFAULT_RATE.
+RATE_LIMITS = {
+    'api.elsevier.com': 5.0,
+    'www.googleapis.com': 5.0,
+}
+DEFAULT_RATE = 10.0
+
+CONNECTIONS_PER_HOST = 8
+MAX_CONNECTIONS = 64
+
+RETRIES = 5
+BACKOFF = 1.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+TIMEOUT = 60
+CHUNK_SIZE = 1 << 16
+
+
+def query_params(params):
+    """Return the query parameters without any set to None, which requests
+    leaves out but aiohttp rejects, e.g., a missing API key."""
+    if params is None:
+        return None
+    return {k: v for k, v in params.items() if v is not None}
+
+
+class TokenBucket:
+    """Rate limiter allowing `rate` requests per second on average, with
+    bursts of up to `capacity` requests."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+class Response:
+    """The status, headers, and body of a completed HTTP request."""
+
+    def __init__(self, status, headers, body, encoding='utf-8'):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    @property
+    def text(self):
+        return self.body.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Fetcher:
+    """Asynchronous HTTP client sharing pooled connections per host, with
+    per-host rate limits and retries with exponential backoff on
+    connection errors and 429/5xx responses. Use it as an async context
+    manager within a running event loop:
+
+        async with Fetcher() as f:
+            r = await f.get(url, params)
+    """
+
+    def __init__(self, rates=None, default_rate=DEFAULT_RATE,
+                 connections_per_host=CONNECTIONS_PER_HOST,
+                 max_connections=MAX_CONNECTIONS, retries=RETRIES,
+                 backoff=BACKOFF, timeout=TIMEOUT, cache=None):
+        self.rates = dict(RATE_LIMITS)
+        if rates:
+            self.rates.update(rates)
+        self.default_rate = default_rate
+        self.connections_per_host = connections_per_host
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.buckets = {}
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=
+                                         self.connections_per_host)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def bucket(self, url):
+        host = urlsplit(url).hostname
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rates.get(host,
+                                                            self.default_rate))
+        return self.buckets[host]
+
+    async def wait(self, attempt, r=None):
+        """Sleep before retrying, honoring any Retry-After header."""
+        delay = self.backoff * 2 ** attempt
+        if r is not None:
+            try:
+                delay = max(delay, float(r.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass
+        await asyncio.sleep(delay)
+
+    async def get(self, url, params=None, headers=None, auth=None):
+        """Return the Response for a GET request, or None if the request
+        failed with connection errors on every attempt or is not cached in
+        offline mode."""
+
+        params = query_params(params)
+
+        # The cache is SQLite, so it's read and written in a worker thread
+        # rather than blocking the event loop.
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, url, params)
+            if cached is not None:
+                return Response(cached[0], {}, cached[1])
+            if self.cache.offline:
+                return None
+
+        response = None
+        for attempt in range(self.retries + 1):
+            await self.bucket(url).acquire()
+            try:
+                async with self.session.get(url, params=params,
+                                            headers=headers,
+                                            auth=auth) as r:
+                    body = await r.read()
+                    response = Response(r.status, r.headers, body,
+                                        r.get_encoding())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(' ! Request error:', url, e, file=sys.stderr)
+                await self.wait(attempt)
+                continue
+            if response.status not in RETRY_STATUSES:
+                break
+            await self.wait(attempt, response)
+
+        if self.cache is not None and response is not None and response.ok:
+            await asyncio.to_thread(self.cache.put, url, params,
+                                    response.status, response.body)
+        return response
+
+    async def download(self, url, path, params=None, headers=None):
+        """Download the URL to the specified path, returning True on
+        success. The body is written to a partial file that is renamed
+        into place once complete. After a dropped connection, the
+        download resumes from the end of the partial file."""
+
+        if self.cache is not None and self.cache.offline:
+            print(' ! Offline; not downloading:', url, file=sys.stderr)
+            return False
+
+        params = query_params(params)
+        part = path + '.part'
+        for attempt in range(self.retries + 1):
+            await self.bucket(url).acquire()
+            req_headers = dict(headers or {})
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset:
+                req_headers['Range'] = 'bytes=%d-' % (offset)
+            try:
+                async with self.session.get(url, params=params,
+                                            headers=req_headers) as r:
+                    if r.status in RETRY_STATUSES:
+                        await self.wait(attempt, r)
+                        continue
+                    if r.status == 416 and offset:
+                        # The partial file can't be resumed; start over.
+                        # Without a Range request, 416 is just an error.
+                        if os.path.exists(part):
+                            os.remove(part)
+                        continue
+                    if r.status not in [200, 206]:
+                        print(' ! Server error:', r.status, url,
+                              file=sys.stderr)
+                        print(await r.text(errors='replace'),
+                              file=sys.stderr)
+                        break
+                    with open(part, 'ab' if r.status == 206 else 'wb') \
+                         as out:
+                        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                            out.write(chunk)
+                os.replace(part, path)
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(' ! Download error:', url, e, file=sys.stderr)
+                await self.wait(attempt)
+
+        print(' ! Download failed:', url, file=sys.stderr)
+        if os.path.exists(part):
+            os.remove(part)
+        return False
+
+
+def fetch_all(requests, **kwargs):
+    """Return the list of Responses (or None) for a list of (url, params)
+    pairs, requested concurrently with a shared Fetcher."""
+
+    async def run():
+        async with Fetcher(**kwargs) as f:
+            return await asyncio.gather(*[f.get(url, params)
+                                          for url, params in requests])
+    return asyncio.run(run())
+
+
+def download_all(downloads, **kwargs):
+    """Download a list of (url, params, path) triples concurrently with a
+    shared Fetcher, returning the list of success values."""
+
+    async def run():
+        async with Fetcher(**kwargs) as f:
+            return await asyncio.gather(*[f.download(url, path, params)
+                                          for url, params, path in downloads])
+    return asyncio.run(run())
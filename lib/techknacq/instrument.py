@@ -0,0 +1,303 @@
+# TechKnAcq: Instrumentation
+# Jonathan Gordon
+
+import sys
+import os
+import io
+import json
+import time
+import atexit
+import cProfile
+import threading
+import functools
+
+from collections import defaultdict
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+# Parameters
+
+# Setting this environment variable to a file name enables instrumentation
+# and writes the structured log there.
+TRACE_ENV = 'TECHKNACQ_TRACE'
+
+# Spans shorter than this are counted but not written to the log.
+LOG_MIN_SECONDS = 0.01
+
+# Blocks that take longer than this are saved by the profiler.
+PROFILE_THRESHOLD = 1.0
+
+METRIC_PREFIX = 'techknacq_'
+
+
+# Instrumentation is off unless enabled, and then every span and counter
+# returns immediately.
+enabled = False
+
+lock = threading.Lock()
+
+# For each span name, the number of times it ended, the total seconds, and
+# the longest.
+spans = {}
+counters = defaultdict(int)
+
+log = None
+log_min_seconds = LOG_MIN_SECONDS
+profiler = None
+
+
+def enable(log_path=None, min_seconds=LOG_MIN_SECONDS, profile_dir=None,
+           profile_threshold=PROFILE_THRESHOLD, profile_tool='cprofile'):
+    """Start collecting spans and counters. Spans of at least
+    `min_seconds` are written to the log file as lines of JSON, and blocks
+    run with `profiled` that take at least `profile_threshold` seconds are
+    profiled to `profile_dir`."""
+
+    global enabled, log, log_min_seconds, profiler
+
+    if log_path and log is None:
+        log = io.open(log_path, 'a', encoding='utf-8', buffering=1)
+        atexit.register(write_summary)
+    log_min_seconds = min_seconds
+    if profile_dir:
+        profiler = Profiler(profile_dir, profile_threshold, profile_tool)
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def write_log(entry):
+    entry['time'] = round(time.time(), 6)
+    entry['pid'] = os.getpid()
+    entry['thread'] = threading.current_thread().name
+    log.write(json.dumps(entry, default=str) + '\n')
+
+
+def record(name, seconds, **fields):
+    """Add a completed span of `seconds` to the totals for its name."""
+    if not enabled:
+        return
+    with lock:
+        stats = spans.get(name)
+        if stats is None:
+            stats = spans[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+        if log is not None and seconds >= log_min_seconds:
+            fields['span'] = name
+            fields['seconds'] = round(seconds, 6)
+            write_log(fields)
+
+
+def count(name, n=1):
+    """Add n to the named counter."""
+    if not enabled:
+        return
+    with lock:
+        counters[name] += n
+
+
+class Span:
+    __slots__ = ['name', 'fields', 'start']
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        record(self.name, time.perf_counter() - self.start, **self.fields)
+
+
+class NullSpan:
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **fields):
+    """Return a context manager timing the block as the named span, with
+    any fields written to the log."""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, fields)
+
+
+def traced(name):
+    """Decorate a function so each call is timed as the named span."""
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def profiled(name):
+    """Return a context manager profiling the block if profiling is
+    enabled."""
+    if not enabled or profiler is None:
+        return NULL_SPAN
+    return profiler.profile(name)
+
+
+class Profiler:
+    """Profile blocks of code with cProfile, or pyinstrument if requested
+    and installed, saving the profile of any block that takes longer than
+    `threshold` seconds to `out_dir`. Only one block is profiled at a time,
+    and blocks in other threads meanwhile run unprofiled."""
+
+    def __init__(self, out_dir, threshold=PROFILE_THRESHOLD, tool='cprofile'):
+        self.out_dir = out_dir
+        self.threshold = threshold
+        self.tool = tool
+        if tool == 'pyinstrument' and pyinstrument is None:
+            print('pyinstrument is not installed; using cProfile.',
+                  file=sys.stderr)
+            self.tool = 'cprofile'
+        self.lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def profile(self, name):
+        return ProfiledBlock(self, name)
+
+    def save(self, prof, name, elapsed):
+        fname = os.path.join(self.out_dir, '%s-%s-%dms' %
+                             (time.strftime('%Y%m%d-%H%M%S'),
+                              ''.join(c if c.isalnum() else '-'
+                                      for c in name)[:60],
+                              elapsed * 1000))
+        if self.tool == 'pyinstrument':
+            fname += '.html'
+            with io.open(fname, 'w', encoding='utf-8') as out:
+                out.write(prof.output_html())
+        else:
+            fname += '.prof'
+            prof.dump_stats(fname)
+        count('profiles.saved')
+        if log is not None:
+            write_log({'profile': fname, 'name': name,
+                       'seconds': round(elapsed, 6)})
+
+
+class ProfiledBlock:
+    __slots__ = ['profiler', 'name', 'prof', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.prof = None
+
+    def __enter__(self):
+        if self.profiler.lock.acquire(blocking=False):
+            if self.profiler.tool == 'pyinstrument':
+                self.prof = pyinstrument.Profiler()
+                self.prof.start()
+            else:
+                self.prof = cProfile.Profile()
+                self.prof.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        if self.prof is None:
+            return None
+        try:
+            if self.profiler.tool == 'pyinstrument':
+                self.prof.stop()
+            else:
+                self.prof.disable()
+            if elapsed >= self.profiler.threshold:
+                self.profiler.save(self.prof, self.name, elapsed)
+        finally:
+            self.prof = None
+            self.profiler.lock.release()
+        return None
+
+
+def metric_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def metrics_text():
+    """Return the spans and counters in the Prometheus text format."""
+
+    with lock:
+        span_stats = sorted(spans.items())
+        counter_values = sorted(counters.items())
+
+    lines = []
+    if span_stats:
+        lines.append('# HELP %sspan_seconds Time spent in each span.' %
+                     (METRIC_PREFIX))
+        lines.append('# TYPE %sspan_seconds summary' % (METRIC_PREFIX))
+        for name, (n, total, _) in span_stats:
+            lines.append('%sspan_seconds_count{span="%s"} %d' %
+                         (METRIC_PREFIX, label(name), n))
+            lines.append('%sspan_seconds_sum{span="%s"} %.6f' %
+                         (METRIC_PREFIX, label(name), total))
+        lines.append('# HELP %sspan_seconds_max Longest time in each span.' %
+                     (METRIC_PREFIX))
+        lines.append('# TYPE %sspan_seconds_max gauge' % (METRIC_PREFIX))
+        for name, (_, _, longest) in span_stats:
+            lines.append('%sspan_seconds_max{span="%s"} %.6f' %
+                         (METRIC_PREFIX, label(name), longest))
+    for name, n in counter_values:
+        lines.append('# TYPE %s%s_total counter' %
+                     (METRIC_PREFIX, metric_name(name)))
+        lines.append('%s%s_total %d' % (METRIC_PREFIX, metric_name(name), n))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """Return a dict of the totals for each span and counter."""
+    with lock:
+        return {'spans': {name: {'count': n, 'seconds': round(total, 6),
+                                 'max_seconds': round(longest, 6)}
+                          for name, (n, total, longest) in spans.items()},
+                'counters': dict(counters)}
+
+
+def write_summary():
+    if log is not None and (spans or counters):
+        entry = summary()
+        entry['summary'] = True
+        with lock:
+            write_log(entry)
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
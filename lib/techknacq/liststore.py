@@ -0,0 +1,322 @@
+# TechKnAcq: Reading List Store
+# Jonathan Gordon
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import multiprocessing as mp
+
+from collections import defaultdict
+
+from techknacq.readinglist import ReadingList, normalize_query, \
+    BEGINNER, INTERMEDIATE, ADVANCED
+from techknacq.instrument import span
+
+
+# Parameters
+
+LEVELS = [BEGINNER, INTERMEDIATE, ADVANCED]
+
+PROCESSES = max(1, int(.5 * mp.cpu_count()))
+
+# Number of reading lists written to the store in each transaction.
+BATCH_SIZE = 500
+
+
+def query_key(q):
+    """Return the key of a query string in the store. Queries with the
+    same key have the same reading list."""
+    return ' '.join(normalize_query(q.strip().split()))
+
+
+def response_json(cg, q, r):
+    """Return the response to the query for techknacq-server, as a dict,
+    given its ReadingList."""
+
+    def topic_entry(topic):
+        nonlocal doc_index, resp
+
+        node = {'id': topic['id'].replace('concept-', ''),
+                'label': topic['name'],
+                'matched': False}
+        resp['graphResponse']['nodes'].append(node)
+
+        entry = {'index': topic['id'].replace('concept-', ''),
+                 'topicName': topic['name'],
+                 'dependentTopics': [],
+                 'documents': []}
+        for doc in topic['documents1']:
+            entry['documents'].append(doc_entry(doc))
+            doc_index += 1
+        for subtopic in topic['subconcepts']:
+            entry['dependentTopics'].append(topic_entry(subtopic))
+        for doc in topic['documents2']:
+            entry['documents'].append(doc_entry(doc))
+            doc_index += 1
+        return entry
+
+    def doc_entry(doc):
+        nonlocal doc_index, r
+        entry = {'index': doc_index,
+                 'id': doc['id'],
+                 'author': '; '.join(doc['authors']),
+                 'authorScore': 0.0,
+                 'title': doc['title'],
+                 'year': doc['year'],
+                 'relevanceScore': 0.0,
+                 'readabilityScore': 0.0,
+                 'pageRankScore': 0.0,
+                 'pedagogicalRole': None,
+                 'relevantTopics': [],
+                 'url': doc['url'],
+                 'abstractText': ' '.join(doc['abstract'])}
+        for topic in r.all_concepts():
+            try:
+                topic_json = {
+                    'topicName': topic['name'],
+                    'strength': cg.doc_topic_strength(doc['id'], topic['id'])
+                }
+                entry['relevantTopics'].append(topic_json)
+            except:
+                continue
+        return entry
+
+    resp = {'keyword': q,
+            'baseLineDocuments': [],
+            'graphResponse': {
+              'edges': [],
+              'nodes': []},
+            'matchTopics': []}
+
+    doc_index = 0
+    with span('server.topics'):
+        for topic in r.rl:
+            resp['matchTopics'].append(topic_entry(topic))
+
+    # Add dependency edges to the graph in the response for all topic nodes
+    # we added.
+    topics = set(['concept-' + x['id'] for x in
+                  resp['graphResponse']['nodes']])
+    with span('server.edges'):
+        edges = graph_edges(cg, topics)
+
+    for node_from in edges:
+        for node_to in edges[node_from]:
+            edge = {'from': node_from,
+                    'to': node_to,
+                    'value': edges[node_from][node_to]}
+            resp['graphResponse']['edges'].append(edge)
+
+    return resp
+
+
+def graph_edges(cg, topics):
+    """Return the dependency edges among the topics, as a dict from each
+    topic number to a dict of the topic numbers it depends on and their
+    weights, made unidirectional and transitively reduced."""
+
+    edges = defaultdict(dict)
+    for topic in topics:
+        for dep_id, dep_weight in cg.topic_deps(topic):
+            if dep_id in topics:
+                node_from = topic.replace('concept-', '')
+                node_to = dep_id.replace('concept-', '')
+                edges[node_from][node_to] = dep_weight
+
+    # Make graph edges unidirectional.
+    new_edges = defaultdict(dict)
+    for node_from in edges:
+        for node_to in edges[node_from]:
+            if node_to in edges and node_from in edges[node_to] and \
+               edges[node_to][node_from] > edges[node_from][node_to]:
+                new_edges[node_to][node_from] = edges[node_to][node_from]
+            else:
+                new_edges[node_from][node_to] = edges[node_from][node_to]
+    edges = dict(new_edges)
+
+    # Perform transitive reduction.
+    remove = []
+    for e1_n1 in edges:
+        for e1_n2 in edges[e1_n1]:
+            for e2_n2 in edges[e1_n1]:
+                if e2_n2 == e1_n2:
+                    continue
+                if e1_n2 in edges.get(e2_n2, []):
+                    remove.append((e1_n1, e1_n2))
+    # Don't disconnect a node. An edge can be listed more than once.
+    for n1, n2 in remove:
+        if n2 not in edges[n1]:
+            continue
+        edges_to_n2 = 0
+        edges_from_n1 = len(edges[n1])
+        for e in edges:
+            if n2 in edges[e]:
+                edges_to_n2 += 1
+        if edges_to_n2 > 1 and edges_from_n1 > 1:
+            del edges[n1][n2]
+
+    return edges
+
+
+class ReadingListStore:
+    """Server responses for queries at each user level, computed ahead of
+    time and stored in SQLite, keyed on the normalized query. The store
+    records the ID of the concept graph they were computed from, and
+    callers should only use it with the same graph.
+
+    Each thread opens its own connection, so a store can be shared by the
+    server's threads. A read-only store must already exist."""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.conns = {}
+
+    def db(self):
+        owner = (os.getpid(), threading.get_ident())
+        conn = self.conns.get(owner)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect('file:%s?mode=ro' % (self.path),
+                                       uri=True)
+            else:
+                conn = sqlite3.connect(self.path, timeout=60)
+                conn.execute('''CREATE TABLE IF NOT EXISTS meta
+                                     (key TEXT PRIMARY KEY, value TEXT)''')
+                conn.execute('''CREATE TABLE IF NOT EXISTS lists
+                                     (query TEXT, level INTEGER, body BLOB,
+                                      PRIMARY KEY (query, level))''')
+            self.conns[owner] = conn
+        return conn
+
+    def graph_id(self):
+        """Return the ID of the concept graph the reading lists are for,
+        or None if the store is empty."""
+        try:
+            row = self.db().execute('SELECT value FROM meta '
+                                    'WHERE key = ?', ('graph',)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def reset(self, graph_id):
+        """Remove all reading lists and mark the store as being for the
+        specified concept graph."""
+        with self.db() as conn:
+            conn.execute('DELETE FROM lists')
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('graph', graph_id))
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('created', str(time.time())))
+
+    def get(self, q, level):
+        """Return the stored response for the query and level as a dict,
+        without a keyword, or None if it isn't stored."""
+        row = self.db().execute('SELECT body FROM lists '
+                                'WHERE query = ? AND level = ?',
+                                (query_key(q), level)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0].decode('utf8'))
+
+    def put_many(self, rows):
+        """Store a list of (query key, level, response dict) triples."""
+        with self.db() as conn:
+            conn.executemany('INSERT OR REPLACE INTO lists VALUES (?, ?, ?)',
+                             [(key, level,
+                               json.dumps(resp, sort_keys=True).encode('utf8'))
+                              for key, level, resp in rows])
+
+    def __len__(self):
+        return self.db().execute('SELECT COUNT(*) FROM lists').fetchone()[0]
+
+
+def init_worker(cg):
+    # Each worker process keeps its own copy of the concept graph, and of
+    # the values it caches, rather than receiving it with every query.
+    global worker_cg
+    worker_cg = cg
+
+
+def materialize_query(q):
+    """Return the (query key, level, response) triples for the query at
+    each user level."""
+    user_model = {}
+    rows = []
+    for level in LEVELS:
+        for c in worker_cg.concepts():
+            user_model[c] = level
+        r = ReadingList(worker_cg, q.split(), user_model)
+        resp = response_json(worker_cg, q, r)
+        # Queries with the same key share the response, so the keyword is
+        # set from the request when it's served.
+        del resp['keyword']
+        rows.append((query_key(q), level, resp))
+    return rows
+
+
+def read_queries(fname):
+    """Return the queries in the specified file, one per line, skipping
+    blank lines and comments starting with '#'."""
+    queries = []
+    for line in open(fname):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            queries.append(line)
+    return queries
+
+
+def materialize(cg, path, queries=None, processes=PROCESSES, append=False):
+    """Compute the server responses for each query at each user level, in
+    parallel, and save them to the store at `path`, replacing any reading
+    lists already in it, or, if `append` is set, adding to them. By
+    default, the queries are the names of the concepts, so a query that
+    names a concept is answered from the store. Returns the number of
+    reading lists stored."""
+
+    if queries is None:
+        queries = [cg.name(c) for c in cg.concepts()]
+    # Queries with the same key have the same reading lists.
+    queries = list({query_key(q): q for q in queries
+                    if query_key(q)}.values())
+
+    store = ReadingListStore(path)
+    if not append or store.graph_id() is None:
+        store.reset(cg.id)
+    elif store.graph_id() != cg.id:
+        raise ValueError('Materialized reading lists in %s are not for this '
+                         'concept graph.' % (path))
+
+    print('Materializing reading lists for %d queries.' % (len(queries)))
+    start = time.time()
+
+    if processes > 1:
+        pool = mp.Pool(processes, initializer=init_worker, initargs=(cg,))
+        results = pool.imap_unordered(materialize_query, queries,
+                                      chunksize=8)
+    else:
+        pool = None
+        init_worker(cg)
+        results = map(materialize_query, queries)
+
+    batch = []
+    stored = 0
+    for rows in results:
+        batch.extend(rows)
+        if len(batch) >= BATCH_SIZE:
+            store.put_many(batch)
+            stored += len(batch)
+            batch = []
+    store.put_many(batch)
+    stored += len(batch)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print('Stored %d reading lists in %.1f s (%.1f/s).' %
+          (stored, elapsed, stored / elapsed if elapsed else 0.0))
+    return stored
@@ -0,0 +1,155 @@
+# TechKnAcq: PDF
+# Jonathan Gordon
+
+import sys
+import os
+import io
+import time
+import signal
+import hashlib
+import threading
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Parameters
+
+# Number of pdftotext processes to run at once. These are separate from any
+# pool of Python worker processes.
+PROCESSES = 4
+
+TIMEOUT = 10
+MIN_PAGES = 3
+MAX_PAGES = 100
+
+CHUNK_SIZE = 1 << 16
+
+
+def file_hash(path):
+    """Return the SHA-1 hex digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PDFExtractor:
+    """Extract text from PDF files with pdftotext, running at most
+    `processes` extractions at once. Text is read from the pdftotext pipe
+    as it is produced, counting pages by form feeds, and extraction stops
+    early if a file has too many pages or takes longer than `timeout`
+    seconds. Extracted text is cached in `cache_dir` by the hash of the
+    PDF, and the time taken for each file is recorded in `timings`."""
+
+    def __init__(self, cache_dir=None, processes=PROCESSES, timeout=TIMEOUT,
+                 min_pages=MIN_PAGES, max_pages=MAX_PAGES):
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.timeout = timeout
+        self.min_pages = min_pages
+        self.max_pages = max_pages
+        self.timings = []
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def extract_all(self, paths):
+        """Return a dict from each path to its extracted text, or None if
+        the text couldn't be extracted or the page count is out of
+        bounds."""
+        with ThreadPoolExecutor(self.processes) as ex:
+            return dict(zip(paths, ex.map(self.extract, paths)))
+
+    def extract(self, path):
+        start = time.time()
+        text, status = self.read_text(path)
+        elapsed = time.time() - start
+        self.timings.append((elapsed, path, status))
+        if status != 'ok' and status != 'cached':
+            print(' ! %s (%.1f s): %s' % (status, elapsed,
+                                          os.path.basename(path)),
+                  file=sys.stderr)
+        if text is None:
+            return None
+
+        # pdftotext ends every page with a form feed.
+        pages = text.count('\f')
+        if pages < self.min_pages or pages > self.max_pages:
+            print(' ! Inappropriate number of pages:',
+                  os.path.basename(path), file=sys.stderr)
+            return None
+        return text
+
+    def read_text(self, path):
+        """Return the text of the PDF and how it was obtained."""
+
+        if not os.path.exists(path):
+            return None, 'Missing file'
+
+        cache_path = None
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir,
+                                      file_hash(path) + '.txt')
+            if os.path.exists(cache_path):
+                with io.open(cache_path, 'r', encoding='utf8') as f:
+                    return f.read(), 'cached'
+
+        try:
+            proc = subprocess.Popen(['pdftotext', path, '-'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    start_new_session=True)
+        except OSError:
+            return None, 'Failed to run pdftotext'
+
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        chunks = []
+        pages = 0
+        status = 'ok'
+        try:
+            for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                chunks.append(chunk)
+                pages += chunk.count(b'\f')
+                if pages > self.max_pages:
+                    kill()
+                    status = 'Too many pages'
+                    break
+            proc.stdout.close()
+            proc.wait()
+        finally:
+            if not timer.is_alive() and status == 'ok':
+                status = 'Timed out'
+            timer.cancel()
+
+        if status != 'ok':
+            return None, status
+        if proc.returncode != 0 or not chunks:
+            return None, 'Failed to get text'
+
+        text = b''.join(chunks).decode('utf8', errors='replace')
+
+        if cache_path:
+            tmp_path = cache_path + '.part'
+            with io.open(tmp_path, 'w', encoding='utf8') as out:
+                out.write(text)
+            os.replace(tmp_path, cache_path)
+
+        return text, status
+
+    def print_timings(self, n=10):
+        """Print the files that took the longest to extract."""
+        if not self.timings:
+            return
+        total = sum(x[0] for x in self.timings)
+        print('-- Extracted %d PDFs in %.1f s.' % (len(self.timings), total))
+        for elapsed, path, status in sorted(self.timings, reverse=True)[:n]:
+            print('   %6.2f s  %-14s %s' % (elapsed, status,
+                                            os.path.basename(path)))
@@ -7,6 +7,8 @@ from collections import defaultdict
 from nltk.tokenize import word_tokenize
 from nltk.stem.lancaster import LancasterStemmer
 
+from techknacq.instrument import traced
+
 
 # Parameters
 
@@ -37,11 +39,44 @@ ADVANCED_DOC_PREFS = [
     'other'
 ]
 
+
+def normalize_query(query):
+    """Return the normalized words of a query given as a list of
+    strings. Queries with the same words have the same reading list."""
+    return word_tokenize(' '.join(query).replace('-', ' ').lower())
+
+
+def rank_docs(cg, c, roles):
+    """Return a tuple of the most relevant documents for the topic,
+    ordered by the preferred pedagogical roles."""
+
+    # 1. Find the most relevant documents for the topic.
+
+    docs = cg.topic_docs(c)
+
+    # 2. Stable sort documents by pedagogical role preference:
+    #    ped_score = 1.0 * role1 + 0.85 * role2 + 0.7 * role3 +
+    #                0.55 * role4 + 0.4 * role5 + 0.25 * role4
+
+    def ped_role_score(doc, role_order):
+        doc_roles = cg.g.node[doc]['roles']
+        score = 0.0
+        for i, role in enumerate(role_order):
+            score += (1.0 - i*.15) * doc_roles.get(role, 0)
+        if cg.g.node[doc].get('length', 0) == 0:
+            return score
+        return score * math.log(cg.g.node[doc]['length'])
+
+    docs.sort(key=lambda x: ped_role_score(x[0], roles), reverse=True)
+
+    return tuple(docs)
+
+
 class ReadingList:
     def __init__(self, cg, query, user_model=None, docs=True):
         self.cg = cg
 
-        self.query = word_tokenize(' '.join(query).replace('-', ' ').lower())
+        self.query = normalize_query(query)
 
         self.user_model = user_model
         if self.user_model is None:
@@ -69,35 +104,22 @@ class ReadingList:
                 break
 
 
+    @traced('readinglist.best_docs')
     def best_docs(self, c, roles=None):
-        """Return an ordered list of the best documents for the topic
-        given an ordered list of preferred pedagogical roles."""
+        """Return an ordered tuple of the best documents for the topic
+        given an ordered list of preferred pedagogical roles. The ranking
+        depends only on the concept graph, so it is computed once per
+        concept and role order and shared by every reading list."""
 
         if roles is None:
             roles = DEFAULT_DOC_PREFS
+        roles = tuple(roles)
 
-        # 1. Find the most relevant documents for the topic.
-
-        docs = self.cg.topic_docs(c)
-
-        # 2. Stable sort documents by pedagogical role preference:
-        #    ped_score = 1.0 * role1 + 0.85 * role2 + 0.7 * role3 +
-        #                0.55 * role4 + 0.4 * role5 + 0.25 * role4
-
-        def ped_role_score(doc, role_order):
-            doc_roles = self.cg.g.node[doc]['roles']
-            score = 0.0
-            for i, role in enumerate(role_order):
-                score += (1.0 - i*.15) * doc_roles.get(role, 0)
-            if self.cg.g.node[doc].get('length', 0) == 0:
-                return score
-            return score * math.log(self.cg.g.node[doc]['length'])
-
-        docs.sort(key=lambda x: ped_role_score(x[0], roles), reverse=True)
-
-        return docs
+        return self.cg.memo(('best_docs', c, roles),
+                            lambda: rank_docs(self.cg, c, roles))
 
 
+    @traced('readinglist.traverse')
     def traverse(self, c, score, depth=1, match_num=1):
         if score < THRESHOLD or c in self.covered_concepts:
             return
@@ -117,8 +139,7 @@ class ReadingList:
         # First compute any dependencies we'll include in the reading list
         # so we know which -- and how many -- documents we want to include
         # at this level.
-        for dep, dep_weight in sorted(self.cg.topic_deps(c),
-                                      key=lambda x: x[1], reverse=True)[:50]:
+        for dep, dep_weight in self.cg.topic_deps(c)[:50]:
             dep_discount = 1
             if self.user_model[c] == INTERMEDIATE:
                 dep_discount = 2
@@ -302,14 +323,21 @@ class ReadingList:
             print('</li>')
 
 
+    def concept_words(self, c):
+        """Return the stemmed words of each n-gram in the concept's
+        model, with its weight."""
+        return [([(x, self.stemmer.stem(x)) for x in ngram.split('_')],
+                 ngram_count/self.cg.g.node[c]['mentions'])
+                for ngram, ngram_count in self.cg.g.node[c]['words']]
+
+
+    @traced('readinglist.score_match')
     def score_match(self, c):
         """Score the relevance of a concept to a query based on lexical
         overlap."""
 
-        concept_words = [([(x, self.stemmer.stem(x)) for x in
-                           ngram.split('_')],
-                          ngram_count/self.cg.g.node[c]['mentions'])
-                         for ngram, ngram_count in self.cg.g.node[c]['words']]
+        concept_words = self.cg.memo(('concept_words', c),
+                                     lambda: self.concept_words(c))
 
         matches = defaultdict(float)
         bonus = 0.0
@@ -334,8 +362,10 @@ class ReadingList:
         else:
             lemma_overlap = \
                 set([x[1] for x in self.query_words]) & \
-                set([self.stemmer.stem(x) for x in
-                     self.cg.g.node[c].get('name', '').lower().split()])
+                self.cg.memo(('name_stems', c),
+                             lambda: set([self.stemmer.stem(x) for x in
+                                          self.cg.g.node[c].get('name', '')
+                                          .lower().split()]))
             # Partial credit
             bonus += .5 * len(lemma_overlap)
 
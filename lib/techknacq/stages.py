@@ -0,0 +1,118 @@
+# TechKnAcq: Stages
+# Jonathan Gordon
+
+import os
+import io
+import json
+import time
+import pickle
+import hashlib
+import threading
+
+
+# Parameters
+
+MANIFEST = 'stages.json'
+
+
+def canonical(x):
+    """Return a JSON-serializable form of the value that doesn't depend on
+    the order of dicts or sets."""
+    if isinstance(x, dict):
+        return sorted(([canonical(k), canonical(v)] for k, v in x.items()),
+                      key=json.dumps)
+    if isinstance(x, (set, frozenset)):
+        return sorted((canonical(v) for v in x), key=json.dumps)
+    if isinstance(x, (list, tuple)):
+        return [canonical(v) for v in x]
+    if x is None or isinstance(x, (str, int, float, bool)):
+        return x
+    return canonical(vars(x))
+
+
+def fingerprint(*values):
+    """Return a hex digest identifying the values."""
+    s = json.dumps(canonical(values))
+    return hashlib.sha1(s.encode('utf8')).hexdigest()
+
+
+def dir_fingerprint(path, names=None):
+    """Return a hex digest identifying the names, sizes, and modification
+    times of the files in a directory, or of a single file. If a list of
+    file names is given, only those files in the directory are included,
+    and any that don't exist are recorded as missing."""
+    if names is not None:
+        return fingerprint([(name,) + file_stat(os.path.join(path, name))
+                            for name in sorted(set(names))])
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(path, f) for f in os.listdir(path))
+    return fingerprint([(os.path.basename(f), os.path.getsize(f),
+                         os.path.getmtime(f))
+                        for f in files if os.path.isfile(f)])
+
+
+def file_stat(path):
+    """Return the size and modification time of a file, or Nones if it
+    doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_size, st.st_mtime
+
+
+class StageRunner:
+    """Run the named stages of a pipeline, saving the output of each to a
+    stage directory. A stage is skipped, and its saved output returned, if
+    it completed before with the same inputs. A manifest in the stage
+    directory records the fingerprint of each stage's inputs, and stages
+    in different threads can be run at once."""
+
+    def __init__(self, stage_dir, restart=False):
+        self.stage_dir = stage_dir
+        self.restart = restart
+        self.lock = threading.Lock()
+        os.makedirs(stage_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(stage_dir, MANIFEST)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with io.open(self.manifest_path, 'r', encoding='utf8') as f:
+                self.manifest = json.load(f)
+
+    def run(self, name, func, *args, key=None):
+        """Return the output of func(*args), computing it only if the
+        stage hasn't completed before with the same inputs. The inputs are
+        identified by `key` if given, or else by the arguments."""
+
+        fp = fingerprint(name, args if key is None else key)
+        path = os.path.join(self.stage_dir, name + '.pickle')
+        entry = self.manifest.get(name)
+        if not self.restart and entry and entry['fingerprint'] == fp and \
+           os.path.exists(path):
+            print('-- Skipping completed stage:', name)
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        print('-- Stage:', name)
+        start = time.time()
+        output = func(*args)
+        elapsed = time.time() - start
+
+        with open(path + '.part', 'wb') as out:
+            pickle.dump(output, out, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.part', path)
+
+        with self.lock:
+            self.manifest[name] = {'fingerprint': fp,
+                                   'completed': time.time(),
+                                   'seconds': elapsed}
+            with io.open(self.manifest_path + '.part', 'w',
+                         encoding='utf8') as out:
+                json.dump(self.manifest, out, indent=2, sort_keys=True)
+            os.replace(self.manifest_path + '.part', self.manifest_path)
+
+        print('-- Completed stage %s in %.1f s.' % (name, elapsed))
+        return output
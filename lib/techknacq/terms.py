@@ -0,0 +1,300 @@
+# TechKnAcq: Terms
+# Jonathan Gordon
+
+import re
+import string
+import numpy as np
+import scipy.sparse as sp
+
+from collections import defaultdict
+from functools import partial
+
+from techknacq.lx import ScrabbleLexicon, StopLexicon
+
+
+# Parameters
+
+# Longest n-gram considered as a term, in tokens.
+MAX_NGRAM = 6
+
+# Number of document titles each worker counts n-grams for per task.
+CHUNK_SIZE = 5000
+
+# Single words found in the Scrabble dictionary that are still terms.
+KEEP_WORDS = {'POS', 'HMM', 'EM', 'PENMAN', 'CHILDES', 'AI'}
+
+# Words (possibly with internal hyphens or periods), clitics like 's, or runs
+# of other characters, approximating NLTK's word tokenizer on titles.
+TOKEN_RE = re.compile(r"\w+(?:[-.]\w+)*-?|'\w*|[^\w\s']+")
+
+
+# Each worker process loads the lexicons once, on first use.
+token_filter = None
+
+
+def tokenize(s):
+    """Return the tokens of the string, preserving case for acronyms but
+    lowercasing everything else."""
+    return [t if t.isupper() and len(t) > 1 else t.lower()
+            for t in TOKEN_RE.findall(s)]
+
+
+class TokenFilter:
+    """Per-token tests for good_ngram, which only need to be computed
+    once for each distinct token."""
+
+    def __init__(self):
+        self.stop = StopLexicon()
+        self.scrabble = ScrabbleLexicon()
+
+    def flags(self, word):
+        """Return whether the word can't appear in an n-gram at all, can't
+        begin or end one, or can't be an n-gram on its own."""
+
+        # N-grams can't contain words with no ASCII letters, e.g., numbers
+        # or symbols.
+        bad = not any(c in string.ascii_letters for c in word) or \
+              '*' in word
+
+        # N-grams can't begin or end with stopwords, e.g., conjunctions,
+        # prepositions, or personal pronouns.
+        bad_edge = word in self.stop or word.lower() in self.stop or \
+                   (word[-1].isdigit() and '-' in word) or \
+                   word[-1] == '-' or word[-1] == '.'
+
+        # Single-word n-grams can't be in the Scrabble dictionary.
+        bad_single = (word.lower() in self.scrabble and
+                      word not in KEEP_WORDS) or not word[0].isalpha()
+
+        return bad, bad_edge, bad_single
+
+
+def good_ngrams(ids, flags, max_n=MAX_NGRAM):
+    """Return the set of good n-grams, as tuples of token IDs, in the
+    sequence of token IDs: They're not single words that would be found in
+    a Scrabble dictionary, and they don't begin or end with a stopword."""
+
+    found = set()
+    for i in range(len(ids)):
+        bad, bad_edge, bad_single = flags[ids[i]]
+        if bad or bad_edge:
+            continue
+        if not bad_single:
+            found.add((ids[i],))
+        for j in range(i + 1, min(i + max_n, len(ids))):
+            bad, bad_edge, _ = flags[ids[j]]
+            if bad:
+                # Every longer n-gram contains this word too.
+                break
+            if not bad_edge:
+                found.add(tuple(ids[i:j+1]))
+    return found
+
+
+def count_chunk(docs, max_n=MAX_NGRAM):
+    """Return the list of distinct tokens in a list of (document number,
+    title) pairs and a dict from each good n-gram, as a tuple of indices
+    into that list, to the list of documents whose titles contain it."""
+
+    global token_filter
+    if token_filter is None:
+        token_filter = TokenFilter()
+
+    vocab = {}
+    words = []
+    flags = []
+    ngram_docs = defaultdict(list)
+    for doc, title in docs:
+        ids = []
+        for token in tokenize(title):
+            i = vocab.get(token)
+            if i is None:
+                i = vocab[token] = len(words)
+                words.append(token)
+                flags.append(token_filter.flags(token))
+            ids.append(i)
+        for ng in good_ngrams(ids, flags, max_n):
+            ngram_docs[ng].append(doc)
+    return words, dict(ngram_docs)
+
+
+def count_ngrams(titles, pool=None, max_n=MAX_NGRAM, chunk_size=CHUNK_SIZE):
+    """Return the list of distinct tokens in the titles and a dict from
+    each good n-gram, as a tuple of indices into that list, to the set of
+    title numbers containing it. Chunks of titles are counted in parallel
+    if a pool is given, each with its own token IDs, which are then mapped
+    onto a shared vocabulary."""
+
+    docs = list(enumerate(titles))
+    chunks = [docs[i:i+chunk_size] for i in range(0, len(docs), chunk_size)]
+    if pool is None:
+        results = (count_chunk(chunk, max_n) for chunk in chunks)
+    else:
+        results = pool.imap(partial(count_chunk, max_n=max_n), chunks)
+
+    vocab = {}
+    words = []
+    ngram_docs = defaultdict(set)
+    for chunk_words, chunk_ngrams in results:
+        ids = []
+        for word in chunk_words:
+            i = vocab.get(word)
+            if i is None:
+                i = vocab[word] = len(words)
+                words.append(word)
+            ids.append(i)
+        for ng, chunk_docs in chunk_ngrams.items():
+            ngram_docs[tuple(ids[i] for i in ng)].update(chunk_docs)
+    return words, ngram_docs
+
+
+def get_terms(corpus, n=4000, pool=None, max_n=MAX_NGRAM):
+    """Return an ordered list of technical terms or names of research
+    topics, based on citation graph density."""
+
+    docs = list(corpus)
+    words, ngrams = count_ngrams([doc.title for doc in docs], pool, max_n)
+
+    # Citations between document numbers, with references outside the
+    # corpus numbered after it.
+    index = {doc.id: i for i, doc in enumerate(docs)}
+    citations = defaultdict(set)
+    for i, doc in enumerate(docs):
+        for ref in doc.references:
+            j = index.setdefault(ref, len(index))
+            citations[i].add(j)
+            citations[j].add(i)
+
+    ngrams = filter_plurals(ngrams, words)
+
+    ngram_counts = {x: len(ngrams[x]) for x in ngrams}
+    filtered = filter_subsumed(ngram_counts)
+
+    if citations:
+        ngrams = score_ngrams(ngrams, citations)
+        ngrams = filter_subsumed(ngrams)
+        ranked = [x for x in sorted(ngrams, key=lambda x: ngrams[x],
+                                    reverse=True) if x in filtered]
+    else:
+        ranked = sorted(filtered, key=lambda x: filtered[x], reverse=True)
+    return [' '.join(words[i] for i in x) for x in ranked[:n]]
+
+
+def filter_plurals(ngrams, words):
+    """Remove regular plurals if the list includes the singular. N-grams
+    are tuples of indices into the list of words."""
+
+    vocab = {w: i for i, w in enumerate(words)}
+    remove = set()
+    for ng in ngrams:
+        for suffix in ['s', 'es']:
+            last = vocab.get(words[ng[-1]] + suffix)
+            if last is None:
+                continue
+            pl = ng[:-1] + (last,)
+            if pl in ngrams:
+                remove.add(pl)
+                try:
+                    # Counts
+                    ngrams[ng] += ngrams[pl]
+                except TypeError:
+                    # Sets of IDs
+                    ngrams[ng] |= ngrams[pl]
+    for ng in remove:
+        del ngrams[ng]
+    return ngrams
+
+
+def filter_subsumed(ngrams):
+    """Remove n-grams whose scores are within 25% of subsuming n+1-grams."""
+
+    remove = set()
+    for ng in ngrams:
+        if len(ng) == 1:
+            continue
+        shorter = ng[:-1]
+        if shorter in ngrams and ngrams[shorter] <= ngrams[ng]*1.3:
+            remove.add(shorter)
+        shorter = ng[1:]
+        if shorter in ngrams and ngrams[shorter] <= ngrams[ng]*1.3:
+            remove.add(shorter)
+    for ng in remove:
+        del ngrams[ng]
+    return ngrams
+
+
+def score_ngrams(ngram_docs, citations, pc=0.9, batch=10000):
+    """Score n-grams based on the density of the citation graph for
+    documents containing them."""
+
+    # Index documents: those in the citation graph first, then the others
+    # in the order their n-grams are scored.
+    ngs = list(ngram_docs)
+    index = {doc: i for i, doc in enumerate(citations)}
+    num_cited = len(index)
+
+    # Sparse n-gram-document incidence matrix.
+    rows = []
+    cols = []
+    for k, ng in enumerate(ngs):
+        for doc in ngram_docs[ng]:
+            rows.append(k)
+            cols.append(index.setdefault(doc, len(index)))
+    incidence = sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                              shape=(len(ngs), len(index)))
+
+    # Sparse (symmetric) citation adjacency matrix.
+    rows = []
+    cols = []
+    for doc in citations:
+        for ref in citations[doc]:
+            rows.append(index[doc])
+            cols.append(index[ref])
+    adjacency = sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                              shape=(len(index), len(index)))
+    degree = np.diff(adjacency.indptr)
+
+    # The number of nodes in the graph when scoring each n-gram, counting
+    # the documents without citations seen for it and all earlier n-grams.
+    by_doc = incidence.tocsc()
+    by_doc.sort_indices()
+    first = by_doc.indices[by_doc.indptr[num_cited:-1]]
+    n = num_cited + np.cumsum(np.bincount(first, minlength=len(ngs)))
+    n = n.astype(float)
+
+    scores = dict()
+    for start in range(0, len(ngs), batch):
+        m = incidence[start:start + batch]
+        end = start + m.shape[0]
+
+        # Connected nodes: documents containing the n-gram that cite or are
+        # cited by another document containing it.
+        connected = m.multiply(m @ adjacency).tocoo()
+        connected.eliminate_zeros()
+        conn_rows = connected.row
+        conn_deg = degree[connected.col]
+
+        # Terms for the equations
+        na = np.diff(m.indptr).astype(float)
+        nca = np.bincount(conn_rows, minlength=len(na)).astype(float)
+        q = 1.0 - (na - 1.0)/(n[start:end] - 1.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Likelihood of observing a tightly connected term citation
+            # graph if the term is a topic.
+            oh1 = nca * np.log(pc) + (na - nca) * np.log(1 - pc)
+
+            # Likelihood of observing a tightly connected term citation
+            # graph if the term is not a topic.
+            term1 = np.bincount(conn_rows,
+                                weights=np.log(1.0 - q[conn_rows]**conn_deg),
+                                minlength=len(na))
+            other_deg = m @ degree - np.bincount(conn_rows, weights=conn_deg,
+                                                 minlength=len(na))
+            term2 = other_deg * np.log(q)
+            oh0 = term1 + term2
+
+        # Skip ones where there aren't enough nodes to count.
+        for k in np.flatnonzero(na >= 4.0):
+            scores[ngs[start + k]] = float(oh1[k] - oh0[k])
+    return scores
@@ -0,0 +1,168 @@
+# TechKnAcq: Wikipedia Dump
+# Jonathan Gordon
+
+import re
+import bz2
+import html
+import xml.etree.ElementTree as ET
+
+
+# Parameters
+
+WIKI_URL = 'https://en.wikipedia.org/wiki/'
+
+# Number of redirects followed when resolving a title.
+MAX_REDIRECTS = 3
+
+
+COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+REF_RE = re.compile(r'<ref[^>]*/>|<ref[^>]*>.*?</ref>', re.S | re.I)
+MEDIA_RE = re.compile(r'\[\[(?:File|Image|Media):[^\[\]]*'
+                      r'(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]', re.I)
+CATEGORY_RE = re.compile(r'\[\[Category:([^\]|]+)(?:\|[^\]]*)?\]\]', re.I)
+LINK_RE = re.compile(r'\[\[([^\]|]*)(?:\|([^\]]*))?\]\]')
+EXT_LINK_RE = re.compile(r'\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]')
+TAG_RE = re.compile(r'<[^>]+>')
+HEADING_RE = re.compile(r'^(=+)\s*(.+?)\s*\1\s*$', re.M)
+LIST_RE = re.compile(r'^[*#:;]+\s*', re.M)
+BLANK_RE = re.compile(r'\n{2,}')
+
+
+def normalize_title(title):
+    """Return the title as MediaWiki stores it: spaces for underscores and
+    an uppercase first letter, without any section anchor."""
+    title = title.split('#', 1)[0].replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def remove_nested(text, start, end):
+    """Remove spans from `start` to the matching `end` delimiter, e.g.,
+    templates, which may be nested."""
+    pattern = re.compile(re.escape(start) + '|' + re.escape(end))
+    out = []
+    depth = 0
+    last = 0
+    for m in pattern.finditer(text):
+        if m.group() == start:
+            if depth == 0:
+                out.append(text[last:m.start()])
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                last = m.end()
+    if depth == 0:
+        out.append(text[last:])
+    return ''.join(out)
+
+
+def parse_wikitext(text):
+    """Return the plain text of an article's wikitext, with headings
+    written as '== Heading ==' lines, and the lists of its categories and
+    linked titles."""
+
+    text = COMMENT_RE.sub('', text)
+    text = REF_RE.sub('', text)
+    text = remove_nested(text, '{{', '}}')
+    text = remove_nested(text, '{|', '|}')
+    text = MEDIA_RE.sub('', text)
+
+    categories = [c.strip() for c in CATEGORY_RE.findall(text)]
+    text = CATEGORY_RE.sub('', text)
+
+    links = []
+
+    def link_text(m):
+        target = m.group(1)
+        if ':' in target:
+            # Interwiki and other namespace links.
+            return ''
+        links.append(normalize_title(target))
+        return m.group(2) if m.group(2) is not None else target
+
+    text = LINK_RE.sub(link_text, text)
+    text = EXT_LINK_RE.sub(r'\1', text)
+    text = text.replace("'''", '').replace("''", '')
+    text = TAG_RE.sub('', text)
+    text = html.unescape(text)
+    text = HEADING_RE.sub(r'\1 \2 \1', text)
+    text = LIST_RE.sub('', text)
+    text = BLANK_RE.sub('\n', text).strip()
+
+    return text, categories, links
+
+
+class WikiDump:
+    """A Wikipedia XML dump (pages-articles.xml or .xml.bz2), read with a
+    streaming parser. Reading the pages builds an index of article titles,
+    including redirects to the articles they name."""
+
+    def __init__(self, path):
+        self.path = path
+        self.titles = {}
+
+    def open(self):
+        if self.path.endswith('.bz2'):
+            return bz2.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def pages(self):
+        """Yield the (title, wikitext) pair for each article in the main
+        namespace, skipping redirects."""
+
+        with self.open() as f:
+            context = ET.iterparse(f, events=('start', 'end'))
+            _, root = next(context)
+            title = ns = redirect = text = None
+            for event, elem in context:
+                if event != 'end':
+                    continue
+                tag = elem.tag.rsplit('}', 1)[-1]
+                if tag == 'title':
+                    title = elem.text
+                elif tag == 'ns':
+                    ns = elem.text
+                elif tag == 'redirect':
+                    redirect = elem.get('title')
+                elif tag == 'text':
+                    text = elem.text or ''
+                elif tag == 'page':
+                    if ns == '0' and title:
+                        if redirect:
+                            self.titles[title] = normalize_title(redirect)
+                        else:
+                            self.titles[title] = title
+                            yield title, text
+                    title = ns = redirect = text = None
+                    # Drop the parsed pages so memory use stays constant.
+                    root.clear()
+
+    def resolve(self, title):
+        """Return the title of the article the title names, following
+        redirects, or None if it isn't an article in the dump."""
+        title = normalize_title(title)
+        for _ in range(MAX_REDIRECTS + 1):
+            target = self.titles.get(title)
+            if target is None or target == title:
+                return target
+            title = target
+        return None
+
+    def resolve_links(self, links):
+        """Return the distinct article titles for a list of links."""
+        resolved = []
+        seen = set()
+        for link in links:
+            title = self.resolve(link)
+            if title and title not in seen:
+                seen.add(title)
+                resolved.append(title)
+        return resolved
+
+
+def article_json(title, text):
+    """Return the dict of an article's title, URL, plain text, categories,
+    and links, as used for WikiArticle, from its wikitext."""
+    content, categories, links = parse_wikitext(text)
+    return {'title': title, 'url': WIKI_URL + title.replace(' ', '_'),
+            'content': content, 'categories': categories, 'links': links}
@@ -1,35 +1,105 @@
 # WebSearch
 # Jonathan Gordon
 
+import os
 import sys
 import urllib
 import requests
 import json
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+# Parameters
+
+# Number of results per page for each search API.
+PAGE_SIZES = {'google': 10, 'bingweb': 50, 'bingcomposite': 50}
+
+# Number of result pages to request at once.
+CONCURRENT_PAGES = 4
+
+
+# The requests session of each process, shared by its WebSearch instances.
+sessions = {}
+sessions_lock = threading.Lock()
+
+def shared_session():
+    """Return the requests session for this process, so connections are
+    pooled across searches and not only across the pages of one search.
+    A forked process makes its own rather than sharing its parent's
+    sockets."""
+    pid = os.getpid()
+    with sessions_lock:
+        if pid not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=CONCURRENT_PAGES)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[pid] = session
+        return sessions[pid]
 
 
 class WebSearch:
-    def __init__(self, site='google', key=None, cx=None):
+    def __init__(self, site='google', key=None, cx=None, cache=None):
         self.site = site
         self.key = key
         self.cx = cx
+        # Optional response cache with get(url, params) and
+        # put(url, params, status, body) methods and an offline flag.
+        self.cache = cache
 
     def search(self, query, limit=10, offset=0):
-        if offset >= limit:
-            return []
+        """Yield up to `limit` WebPage results for the query, counting
+        from `offset`. Result pages are requested concurrently and results
+        are yielded in order as their pages arrive."""
 
         if self.site in ['bingweb', 'bingcomposite']:
-            results = self.search_bing(query, limit, offset)
+            search_page = self.search_bing
         elif self.site == 'google':
-            results = self.search_google(query, limit, offset)
+            search_page = self.search_google
         else:
             print('Invalid site', self.site, file=sys.stderr)
-            return []
-
-        if results == []:
-            return []
-
-        return results + self.search(query, limit=limit,
-                                     offset=offset + len(results))
+            return
+
+        offsets = range(offset, limit, PAGE_SIZES[self.site])
+        if not offsets:
+            return
+
+        count = offset
+        with ThreadPoolExecutor(min(CONCURRENT_PAGES, len(offsets))) as ex:
+            pages = [ex.submit(search_page, query, limit, x) for x in offsets]
+            try:
+                for page in pages:
+                    results = page.result()
+                    if not results:
+                        return
+                    for result in results:
+                        yield result
+                        count += 1
+                        if count >= limit:
+                            return
+            finally:
+                for page in pages:
+                    page.cancel()
+
+
+    def get(self, url, params=None, auth=None):
+        """Return the status and text of the response to a GET request,
+        using the cache if there is one."""
+
+        if self.cache is not None:
+            cached = self.cache.get(url, params)
+            if cached is not None:
+                return cached[0], cached[1].decode('utf8')
+            if self.cache.offline:
+                return None, ''
+
+        r = shared_session().get(url, params=params, auth=auth)
+        if self.cache is not None and r.status_code == requests.codes.ok:
+            self.cache.put(url, params, r.status_code, r.content)
+        return r.status_code, r.text
 
 
     def search_bing(self, query, limit=50, offset=0):
@@ -47,12 +117,12 @@ class WebSearch:
         if self.site == 'bingcomposite':
             url += '&Sources=web'
 
-        r = requests.get(url, auth=('', self.key))
+        status, text = self.get(url, auth=('', self.key))
 
         try:
-            j = r.json()
+            j = json.loads(text)
         except (ValueError, KeyError):
-            print('WebSearch Error: HTTP %s\n%s' % (r.status_code, r.text),
+            print('WebSearch Error: HTTP %s\n%s' % (status, text),
                   file=sys.stderr)
             return []
 
@@ -65,6 +135,15 @@ class WebSearch:
                   file=sys.stderr)
             return []
 
+        url, vals = self.google_request(query, offset)
+        status, text = self.get(url, params=vals)
+        return self.google_results(status, text, limit, offset)
+
+
+    def google_request(self, query, offset=0):
+        """Return the URL and parameters of the request for a page of
+        Google results, so it can be sent by another HTTP client."""
+
         url = 'https://www.googleapis.com/customsearch/v1'
         vals = {'cx': self.cx,
                 'key': self.key,
@@ -74,12 +153,18 @@ class WebSearch:
         if offset != 0:
             vals['start'] = offset
 
-        r = requests.get(url, params=vals)
+        return url, vals
+
+
+    def google_results(self, status, text, limit=10, offset=0):
+        """Return the WebPages in the response to a request for a page of
+        Google results."""
+
         try:
-            j = json.loads(r.text)
+            j = json.loads(text)
             results = j['items']
         except (ValueError, KeyError):
-            print('WebSearch Error: HTTP %s\n%s' % (r.status_code, r.text),
+            print('WebSearch Error: HTTP %s\n%s' % (status, text),
                   file=sys.stderr)
             return []
 
@@ -88,9 +173,12 @@ class WebSearch:
 
 
 class WebPage:
+    __slots__ = ['url', 'title', 'description']
+
     def __init__(self, j):
         self.url = None
         self.title = None
+        self.description = ''
 
         if 'link' in j:
             self.url = j['link']
@@ -110,3 +198,5 @@ class WebPage:
 
         if 'snippet' in j:
             self.description = j['snippet']
+        elif 'Description' in j:
+            self.description = j['Description']
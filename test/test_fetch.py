@@ -0,0 +1,202 @@
+# TechKnAcq: Fetcher Tests
+# Jonathan Gordon
+
+import os
+import time
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from techknacq.fetch import Fetcher
+from techknacq.cache import ResponseCache
+
+
+# Parameters
+
+BODY = bytes(range(256)) * 64
+
+# Short enough to keep the tests fast, long enough to measure.
+BACKOFF = 0.05
+RETRY_AFTER = 0.3
+
+
+class StubServer:
+    """Local HTTP server whose handlers send scripted responses and record
+    the headers of each request."""
+
+    def __init__(self):
+        self.requests = []
+        self.app = web.Application()
+        self.runner = None
+        self.url = None
+
+    def route(self, path, handler):
+        async def record(request):
+            self.requests.append(dict(request.headers))
+            return await handler(request)
+        self.app.router.add_get(path, record)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:%d' % (port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def scripted(*responses):
+    """Return a handler sending each of the (status, headers) responses in
+    turn, and then BODY with status 200."""
+    remaining = list(responses)
+
+    async def handler(request):
+        if remaining:
+            status, headers = remaining.pop(0)
+            return web.Response(status=status, headers=headers)
+        return web.Response(body=BODY)
+    return handler
+
+
+async def ranged(request):
+    """Send BODY, or the requested part of it with status 206."""
+    start = int(request.headers.get('Range', 'bytes=0-')[6:-1])
+    if start >= len(BODY):
+        return web.Response(status=416)
+    if start:
+        return web.Response(status=206, body=BODY[start:], headers={
+            'Content-Range': 'bytes %d-%d/%d' % (start, len(BODY) - 1,
+                                                 len(BODY))})
+    return web.Response(body=BODY)
+
+
+class FetcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = StubServer()
+        self.server.route('/429', scripted((429, {'Retry-After':
+                                                  str(RETRY_AFTER)})))
+        self.server.route('/503', scripted((503, {}), (502, {})))
+        self.server.route('/416', scripted((416, {})))
+        self.server.route('/404', scripted(*[(404, {})] * 10))
+        self.server.route('/ranged', ranged)
+        self.server.route('/slow', self.slow)
+        await self.server.start()
+        self.dir = tempfile.mkdtemp()
+        self.fetcher = Fetcher(default_rate=1000.0, backoff=BACKOFF,
+                               retries=3)
+        await self.fetcher.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.fetcher.__aexit__(None, None, None)
+        await self.server.stop()
+        shutil.rmtree(self.dir)
+
+    async def slow(self, request):
+        """Send BODY in two parts, noting which files exist between
+        them."""
+        r = web.StreamResponse()
+        r.content_length = len(BODY)
+        await r.prepare(request)
+        await r.write(BODY[:len(BODY)//2])
+        await asyncio.sleep(0.1)
+        self.midway = (os.path.exists(self.path),
+                       os.path.exists(self.path + '.part'))
+        await r.write(BODY[len(BODY)//2:])
+        await r.write_eof()
+        return r
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, 'doc.pdf')
+
+    async def test_retry_after(self):
+        start = time.monotonic()
+        r = await self.fetcher.get(self.server.url + '/429')
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.body, BODY)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertGreaterEqual(time.monotonic() - start, RETRY_AFTER)
+
+    async def test_backoff(self):
+        start = time.monotonic()
+        r = await self.fetcher.get(self.server.url + '/503')
+        self.assertEqual(r.status, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        # Waits of BACKOFF and then 2 * BACKOFF.
+        self.assertGreaterEqual(time.monotonic() - start, 3 * BACKOFF)
+
+    async def test_no_retry(self):
+        # Parameters set to None are left out, as by requests.
+        r = await self.fetcher.get(self.server.url + '/404', {'key': None})
+        self.assertEqual(r.status, 404)
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_cache(self):
+        self.fetcher.cache = ResponseCache(os.path.join(self.dir, 'cache.db'))
+        for _ in range(2):
+            r = await self.fetcher.get(self.server.url + '/503', {'q': 'x'})
+            self.assertEqual(r.body, BODY)
+        self.assertEqual(len(self.server.requests), 3)
+        self.fetcher.cache.offline = True
+        r = await self.fetcher.get(self.server.url + '/503', {'q': 'y'})
+        self.assertIsNone(r)
+
+    async def test_resume(self):
+        with open(self.path + '.part', 'wb') as out:
+            out.write(BODY[:1000])
+        ok = await self.fetcher.download(self.server.url + '/ranged',
+                                         self.path)
+        self.assertTrue(ok)
+        self.assertEqual(self.server.requests[0].get('Range'),
+                         'bytes=1000-')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    async def test_restart(self):
+        # A partial file that can't be resumed is downloaded again.
+        with open(self.path + '.part', 'wb') as out:
+            out.write(BODY + b'extra')
+        ok = await self.fetcher.download(self.server.url + '/ranged',
+                                         self.path)
+        self.assertTrue(ok)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn('Range', self.server.requests[1])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+
+    async def test_atomic_rename(self):
+        ok = await self.fetcher.download(self.server.url + '/slow',
+                                         self.path)
+        self.assertTrue(ok)
+        # Midway, only the partial file existed.
+        self.assertEqual(self.midway, (False, True))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    async def test_failure(self):
+        ok = await self.fetcher.download(self.server.url + '/404',
+                                         self.path)
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    async def test_unrequested_416(self):
+        # A 416 without a Range request is an error for this download
+        # only.
+        ok = await self.fetcher.download(self.server.url + '/416',
+                                         self.path)
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
 import os
+import multiprocessing as mp
+import numpy as np
+import scipy.sparse as sp
+
 from pathlib import Path
 import click
 
@@ -8,43 +12,91 @@ from mallet import Mallet
 
 MALLET_PATH = '../ext/mallet/bin/mallet'
 
-
-def alt_dt(model, corpus, fout):
+PROCESSES = int(.5 * mp.cpu_count())
+CHUNK_SIZE = 1000
+
+
+def init_worker(vocab, wt):
+    # Each worker process keeps its own copy of the word-topic matrix rather
+    # than receiving it with every chunk.
+    global worker_vocab, worker_wt
+    worker_vocab = vocab
+    worker_wt = wt
+
+
+def score_chunk(fnames):
+    """Return a (documents x topics) array of the mean topic weight of the
+    words in each of the specified text files, and the length of each
+    file in words."""
+
+    rows = []
+    cols = []
+    lengths = np.zeros(len(fnames))
+    for i, fname in enumerate(fnames):
+        words = open(fname).read().split()
+        lengths[i] = len(words)
+        for word in words:
+            col = worker_vocab.get(word)
+            if col is not None:
+                rows.append(i)
+                cols.append(col)
+
+    # Duplicate (row, col) entries are summed, giving term counts.
+    dt = sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                       shape=(len(fnames), worker_wt.shape[0]))
+    scores = np.asarray((dt @ worker_wt).todense())
+    nonempty = lengths > 0
+    scores[nonempty] /= lengths[nonempty, None]
+    return scores, lengths
+
+
+def alt_dt(model, corpus, fout, pool):
     """Produce an alternative document-topic matrix giving the importance of
     a document to the topic rather than vice versa, which we compute by
     summing (and then normalizing) the weight of each document word in the
     topic."""
 
     print('Computing alternative document-topic composition matrix.')
-    num_topics = len(model.topics)
-    scores = [{} for i in range(num_topics)]
 
-    for topic in range(num_topics):
-        fout.write('%d' % (topic))
+    doc_ids = list(corpus)
+    fnames = [corpus[doc] for doc in doc_ids]
+
+    scores = []
+    lengths = []
+    chunks = [fnames[i:i+CHUNK_SIZE] for i in range(0, len(fnames),
+                                                     CHUNK_SIZE)]
+    for chunk_scores, chunk_lengths in pool.imap(score_chunk, chunks):
+        scores.append(chunk_scores)
+        lengths.append(chunk_lengths)
+    if not scores:
+        return []
+    scores = np.vstack(scores)
+    lengths = np.concatenate(lengths)
+
+    # Empty documents are not scored at all.
+    nonempty = lengths > 0
+    doc_ids = [doc for doc, keep in zip(doc_ids, nonempty) if keep]
+    scores = scores[nonempty]
+
+    # Normalize each topic by its highest-scoring document.
+    max_scores = scores.max(axis=0) if len(doc_ids) else \
+                 np.zeros(scores.shape[1])
+    has_max = max_scores > 0.0
+    scores[:, has_max] /= max_scores[has_max]
+
+    for topic in range(scores.shape[1]):
         if topic % 50 == 0:
             print('Topic', topic)
-        max_score = 0.0
-        for doc in corpus:
-            if len(corpus[doc]) == 0:
-                continue
-            scores[topic][doc] = 0.0
-            for word in corpus[doc]:
-                scores[topic][doc] += model.topics[topic].get(word, 0.0)
-            scores[topic][doc] /= len(corpus[doc])
-            if scores[topic][doc] > max_score:
-                max_score = scores[topic][doc]
-        if max_score == 0.0:
+        col = scores[:, topic]
+        if not has_max[topic]:
+            fout.write('%d\n' % (topic))
             continue
-        for doc in corpus:
-            scores[topic][doc] /= max_score
-
-        for doc, weight in scores[topic].items():
-            if weight != 0.0:
-                fout.write('\t%s:%f' % (doc, weight))
-        fout.write('\n')
+        fout.write(''.join(['%d' % (topic)] +
+                           ['\t%s:%f' % (doc_ids[i], col[i])
+                            for i in np.flatnonzero(col)]) + '\n')
 
     # Convert scores to topic_doc format.
-    return [scores[i].items() for i in range(num_topics)]
+    return [list(zip(doc_ids, scores[:, i])) for i in range(scores.shape[1])]
 
 
 @click.command()
@@ -56,14 +108,17 @@ def main(text_corpus_dir, topic_model_prefix):
                 if f.is_file()):
         doc_id = os.path.basename(doc).replace('.txt', '')
         if doc_id and doc_id != ' ':
-            corpus[doc_id] = open(doc).read().split()
+            corpus[doc_id] = doc
 
     print('Read corpus of size', len(corpus))
 
     model = Mallet(MALLET_PATH, prefix=topic_model_prefix)
+    vocab, wt = model.word_topic_matrix()
 
-    with open('alt-dt.txt', 'w') as fout:
-        alt_dt(model, corpus, fout)
+    with mp.Pool(PROCESSES, initializer=init_worker,
+                 initargs=(vocab, wt)) as pool, \
+         open('alt-dt.txt', 'w') as fout:
+        alt_dt(model, corpus, fout, pool)
 
 
 if __name__ == '__main__':